@@ -9,36 +9,76 @@ the digital twin topic: "digitaltwin/data".
   * job/telemetry    : temperature, vibration, seq, timestamp
   * jobshop/status   : failure/repair events (for optional labeling)
 - Publishes:
-  * digitaltwin/data : normalized feature rows (JSON), flushed after a small
-                       tick delay to allow attaching near-future failure labels.
+  * digitaltwin/data         : normalized feature rows as JSON objects (default)
+  * digitaltwin/data/msgpack : the same rows as MessagePack arrays in ROW_FIELDS
+                               order (--encoding msgpack)
+  Rows are flushed after a small tick delay to allow attaching near-future
+  failure labels. Consumers of the msgpack topic can use decode_row().
 
 Run:
   python edge_publisher.py --broker localhost --port 1883 --window 5 --flush_delay 1
 
 Optional CSV mirroring for debugging:
   --csv out.csv   (writes the same published rows locally)
+  --verbose       (logs every incoming message; off by default on the hot path)
 """
 
 import argparse
 import json
 import sys
 import csv
+import functools
 import os
+import socket
+import time
 from datetime import datetime, timezone
 from collections import defaultdict, deque
 from typing import Dict, Any, List, Optional
 import paho.mqtt.client as mqtt
 
+from rolling_stats import RollingStats
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
 # ---------- MQTT topics (in) ----------
 STATUS_TOPIC = "job/status"
 TELEM_TOPIC  = "job/telemetry"
+TELEM_BATCH_TOPIC = "job/telemetry/batch"   # {"t": tick, "items": [telemetry, ...]}
 EVENTS_TOPIC = "jobshop/status"
 
-# ---------- MQTT topic (out) ----------
+# ---------- MQTT topics (out) ----------
 PUBLISH_TOPIC = "digitaltwin/data"
+PUBLISH_TOPIC_MSGPACK = "digitaltwin/data/msgpack"
 
 EDGE_VERSION = "1.0.0"
 
+# CSV row schema; published rows are these plus "source"
+FIELDS = (
+    "timestamp_iso","epoch_ms","tick","machine_id","class_name","seq",
+    "temperature_c","vibration_rms_mm_s",
+    "temp_threshold","vib_threshold",
+    "dt_seconds","d_temp","d_vibration",
+    "pct_of_temp_thresh","pct_of_vib_thresh",
+    "temp_avg_win","temp_std_win","vib_avg_win","vib_std_win",
+    "failure_flag","window_size","edge_version",
+)
+
+# Published row schema; msgpack rows are positional arrays in this order
+ROW_FIELDS = FIELDS + ("source",)
+
+# Blank published row; copied per telemetry sample instead of rebuilding the literal
+_ROW_TEMPLATE = dict.fromkeys(ROW_FIELDS)
+_ROW_TEMPLATE["edge_version"] = EDGE_VERSION
+_ROW_TEMPLATE["source"] = "edge"
+
 # ----------------- CSV helpers (optional mirror) -----------------
 def ensure_header(path: str, fieldnames: List[str]):
     exists = os.path.exists(path) and os.path.getsize(path) > 0
@@ -53,44 +93,86 @@ def append_csv(path: str, fieldnames: List[str], row: Dict[str, Any]):
         w = csv.DictWriter(f, fieldnames=fieldnames)
         w.writerow(out)
 
+# ----------------- serialization -----------------
+# Parses MQTT payload bytes directly (no intermediate str); both raise ValueError
+loads = orjson.loads if orjson is not None else json.loads
+
+def encode_row(row: Dict[str, Any]) -> bytes:
+    """Serialize a row to compact UTF-8 JSON bytes (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(row, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(row, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def pack_row(row: Dict[str, Any]) -> bytes:
+    """Serialize a row to a MessagePack array of its ROW_FIELDS values (no key strings)."""
+    return msgpack.packb([row[k] for k in ROW_FIELDS], use_bin_type=True)
+
+def decode_row(payload: bytes) -> Dict[str, Any]:
+    """
+    Inverse of pack_row: rebuild the keyed row from a msgpack payload.
+    The offline will message is a msgpack map and comes back as-is.
+    """
+    obj = msgpack.unpackb(payload, raw=False)
+    return obj if isinstance(obj, dict) else dict(zip(ROW_FIELDS, obj))
+
 # ----------------- time utils -----------------
-def to_epoch_ms(ts: Any) -> int:
-    # Accept ints (ticks) or ISO8601 strings
+def _now_ms() -> int:
+    return int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+
+@functools.lru_cache(maxsize=4096)
+def _parse_ts(s: str) -> Optional[tuple]:
+    """(tick, epoch_ms) for a numeric or ISO8601 string, None if unparseable; cached per string."""
     try:
-        return int(float(ts) * 1000)  # numeric tick => seconds → ms
-    except Exception:
+        f = float(s)
+        return int(f), int(f * 1000)
+    except (ValueError, OverflowError):
         pass
     try:
-        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
-        return int(dt.timestamp() * 1000)
-    except Exception:
-        return int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+        ms = int(datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return None
+    return ms // 1000, ms
 
-def mk_iso(epoch_ms: int) -> str:
-    return datetime.fromtimestamp(epoch_ms/1000, tz=timezone.utc).isoformat().replace("+00:00", "Z")
+def to_epoch_ms(ts: Any) -> int:
+    # Accept ints (ticks) or ISO8601 strings; numbers skip parsing entirely
+    t = type(ts)
+    if t is int:
+        return ts * 1000  # numeric tick => seconds → ms
+    if t is float:
+        try:
+            return int(ts * 1000)
+        except (ValueError, OverflowError):
+            return _now_ms()
+    parsed = _parse_ts(str(ts))
+    return parsed[1] if parsed is not None else _now_ms()
+
+def mk_iso(epoch_ms: int, _gmtime=time.gmtime) -> str:
+    # Same text as datetime.isoformat() + "Z" (no fraction on whole seconds), without the datetime
+    secs, ms = divmod(int(epoch_ms), 1000)
+    y, mo, d, h, mi, s = _gmtime(secs)[:6]
+    if ms:
+        return f"{y:04d}-{mo:02d}-{d:02d}T{h:02d}:{mi:02d}:{s:02d}.{ms:03d}000Z"
+    return f"{y:04d}-{mo:02d}-{d:02d}T{h:02d}:{mi:02d}:{s:02d}Z"
 
 def tick_from_ts(ts: Any) -> int:
     # Prefer integer tick if provided; otherwise derive from epoch seconds
-    try:
-        return int(float(ts))
-    except Exception:
-        return int(to_epoch_ms(ts) // 1000)
-
-# ----------------- stats -----------------
-def std_of(buf: deque) -> float:
-    n = len(buf)
-    if n < 2:
-        return 0.0
-    mean = sum(buf)/n
-    var = sum((x - mean) ** 2 for x in buf) / (n - 1)
-    return var ** 0.5
+    t = type(ts)
+    if t is int:
+        return ts
+    if t is float:
+        try:
+            return int(ts)
+        except (ValueError, OverflowError):
+            return _now_ms() // 1000
+    parsed = _parse_ts(str(ts))
+    return parsed[0] if parsed is not None else _now_ms() // 1000
 
 # ----------------- main -----------------
 def main():
-    parser = argparse.ArgumentParser(description="Edge publisher: MQTT → normalized JSON → digitaltwin/data")
+    parser = argparse.ArgumentParser(description="Edge publisher: MQTT → normalized rows → digitaltwin/data")
     parser.add_argument("--broker", default="localhost")
     parser.add_argument("--port", type=int, default=1883)
-    parser.add_argument("--in_topics", nargs="*", default=[STATUS_TOPIC, TELEM_TOPIC, EVENTS_TOPIC],
+    parser.add_argument("--in_topics", nargs="*", default=[STATUS_TOPIC, TELEM_TOPIC, TELEM_BATCH_TOPIC, EVENTS_TOPIC],
                         help="Input topics to subscribe (space-separated)")
     parser.add_argument("--window", type=int, default=5, help="Rolling window (samples) per machine")
     parser.add_argument("--flush_delay", type=int, default=1,
@@ -98,30 +180,38 @@ def main():
     parser.add_argument("--qos", type=int, default=0, choices=[0,1,2], help="MQTT QoS for publish")
     parser.add_argument("--retain", action="store_true", help="Retain published messages (default: False)")
     parser.add_argument("--csv", default=None, help="Optional CSV mirror of published rows")
+    parser.add_argument("--verbose", action="store_true", help="Log every incoming message to the console")
+    parser.add_argument("--encoding", choices=["msgpack", "json"],
+                        default="json",
+                        help="Wire format for published rows (msgpack → digitaltwin/data/msgpack)")
     args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+    if args.encoding == "msgpack" and msgpack is None:
+        parser.error("--encoding msgpack requires the 'msgpack' package")
+
+    if args.encoding == "msgpack":
+        out_topic, encode = PUBLISH_TOPIC_MSGPACK, pack_row
+    else:
+        out_topic, encode = PUBLISH_TOPIC, encode_row
 
     # Caches
     status_cache: Dict[str, Dict[str, Any]] = {}        # machine_id -> {"class_name","temp_threshold","vib_threshold"}
     prev_point  : Dict[str, Dict[str, Any]] = {}        # machine_id -> {"epoch_ms","tick","temp","vib"}
-    roll        : Dict[str, Dict[str, deque]] = defaultdict(lambda: {"temp": deque(maxlen=args.window),
-                                                                     "vib" : deque(maxlen=args.window)})
+    roll        : Dict[str, Dict[str, RollingStats]] = defaultdict(lambda: {"temp": RollingStats(args.window),
+                                                                            "vib" : RollingStats(args.window)})
 
     # Pending telemetry rows (not flushed yet) to allow labeling with near-future events
-    pending_rows: Dict[str, List[Dict[str, Any]]] = defaultdict(list)  # machine_id -> [row_dict,...]
+    # Rows arrive in tick order per machine, so the oldest is always at the left
+    pending_rows: Dict[str, deque] = defaultdict(deque)  # machine_id -> deque[row_dict,...]
 
     # Failure events by machine & tick
-    failure_ticks: Dict[str, set] = defaultdict(set)  # machine_id -> {tick_int, ...}
+    failure_ticks: Dict[str, deque] = defaultdict(deque)  # machine_id -> recent tick_ints, oldest first
+    # Failures older than this can no longer label a pending row
+    fail_horizon = max(64, args.flush_delay + 2)
 
     # Optional CSV schema
-    csv_fields = [
-        "timestamp_iso","epoch_ms","tick","machine_id","class_name","seq",
-        "temperature_c","vibration_rms_mm_s",
-        "temp_threshold","vib_threshold",
-        "dt_seconds","d_temp","d_vibration",
-        "pct_of_temp_thresh","pct_of_vib_thresh",
-        "temp_avg_win","temp_std_win","vib_avg_win","vib_std_win",
-        "failure_flag","window_size","edge_version"
-    ]
+    csv_fields = list(FIELDS)
     if args.csv:
         ensure_header(args.csv, csv_fields)
 
@@ -129,6 +219,13 @@ def main():
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
             print("[MQTT] Connected")
+            # Larger kernel send buffer absorbs the per-tick burst of rows across machines
+            sock = client.socket()
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+                except (OSError, AttributeError):
+                    pass
             for t in args.in_topics:
                 client.subscribe(t, qos=0)
                 print(f"[MQTT] Subscribed: {t}")
@@ -137,8 +234,7 @@ def main():
 
     def publish_row(row: Dict[str, Any]):
         """Publish normalized row to the digital twin topic and optionally mirror to CSV."""
-        payload = json.dumps(row, separators=(",", ":"), ensure_ascii=False)
-        client.publish(PUBLISH_TOPIC, payload, qos=args.qos, retain=args.retain)
+        client.publish(out_topic, encode(row), qos=args.qos, retain=args.retain)
         if args.csv:
             append_csv(args.csv, csv_fields, row)
 
@@ -147,26 +243,116 @@ def main():
         Flush rows whose tick is <= current_tick - flush_delay.
         Label as 1 if FAILED at same tick or the immediate next tick.
         """
-        if machine_id not in pending_rows:
+        pending = pending_rows.get(machine_id)
+        if not pending:
             return
-        keep = []
-        for row in pending_rows[machine_id]:
-            row_tick = row["tick"]
-            if row_tick <= (current_tick - args.flush_delay):
-                fails = failure_ticks[machine_id]
-                label = 1 if (row_tick in fails or (row_tick + 1) in fails) else 0
-                row["failure_flag"] = label
-                publish_row(row)
+        cutoff = current_tick - args.flush_delay
+        if pending[0]["tick"] > cutoff:
+            return
+        recent = failure_ticks.get(machine_id)
+        fails = set(recent) if recent else None
+        while pending and pending[0]["tick"] <= cutoff:
+            row = pending.popleft()
+            if fails:
+                row_tick = row["tick"]
+                row["failure_flag"] = 1 if (row_tick in fails or (row_tick + 1) in fails) else 0
             else:
-                keep.append(row)
-        pending_rows[machine_id] = keep
+                row["failure_flag"] = 0
+            publish_row(row)
+
+    def handle_telemetry(obj):
+        """One telemetry reading: a job/telemetry message or an item of a batch."""
+        m_id = obj.get("machine_id")
+        if not m_id:
+            return
+
+        # Per-machine state, looked up once per message
+        sc = status_cache.get(m_id) or {}
+        pp = prev_point.get(m_id)
+        rolls = roll[m_id]
+        rt, rv = rolls["temp"], rolls["vib"]
+
+        ts_raw   = obj["timestamp"] if "timestamp" in obj else datetime.now(tz=timezone.utc).isoformat().replace("+00:00","Z")
+        epoch_ms = to_epoch_ms(ts_raw)
+        tick     = tick_from_ts(ts_raw)
+        cls      = obj.get("class_name") or sc.get("class_name")
+        seq      = obj.get("seq")
+
+        # Raw signals (only temp & vibration as requested)
+        temp = obj.get("temperature_c") or obj.get("temperature") or obj.get("temp")
+        vib  = obj.get("vibration_rms_mm_s") or obj.get("vibration")
+
+        # Thresholds
+        t_thresh = sc.get("temp_threshold")
+        v_thresh = sc.get("vib_threshold")
+
+        # Convert once; everything below works on the float copies
+        try:
+            temp_f = None if temp is None else float(temp)
+            vib_f  = None if vib is None else float(vib)
+            t_thresh_f = None if t_thresh in (None, "") else float(t_thresh)
+            v_thresh_f = None if v_thresh in (None, "") else float(v_thresh)
+        except (TypeError, ValueError):
+            print(f"[WARN] Non-numeric telemetry for {m_id}: {str(obj)[:120]}", file=sys.stderr)
+            return
+
+        # Deltas & dt
+        dt_s, d_temp, d_vib = None, None, None
+        if pp is not None:
+            dt_s = (epoch_ms - pp["epoch_ms"]) / 1000.0
+            if temp_f is not None and pp["temp"] is not None:
+                d_temp = temp_f - pp["temp"]
+            if vib_f is not None and pp["vib"] is not None:
+                d_vib = vib_f - pp["vib"]
+        prev_point[m_id] = {"epoch_ms": epoch_ms, "tick": tick, "temp": temp_f, "vib": vib_f}
+
+        # Rolling stats
+        if temp_f is not None: rt.append(temp_f)
+        if vib_f  is not None: rv.append(vib_f)
+        temp_avg = rt.avg
+        vib_avg  = rv.avg
+        temp_std = rt.std
+        vib_std  = rv.std
+
+        # Normalized to thresholds
+        pct_temp = temp_f / t_thresh_f if temp_f is not None and t_thresh_f else None
+        pct_vib  = vib_f / v_thresh_f if vib_f is not None and v_thresh_f else None
+
+        # All values are already float or None
+        row = _ROW_TEMPLATE.copy()
+        row["timestamp_iso"] = mk_iso(epoch_ms)
+        row["epoch_ms"] = epoch_ms
+        row["tick"] = tick
+        row["machine_id"] = m_id
+        row["class_name"] = cls
+        row["seq"] = seq
+        row["temperature_c"] = temp_f
+        row["vibration_rms_mm_s"] = vib_f
+        row["temp_threshold"] = t_thresh_f
+        row["vib_threshold"] = v_thresh_f
+        row["dt_seconds"] = dt_s
+        row["d_temp"] = d_temp
+        row["d_vibration"] = d_vib
+        row["pct_of_temp_thresh"] = pct_temp
+        row["pct_of_vib_thresh"] = pct_vib
+        row["temp_avg_win"] = temp_avg
+        row["temp_std_win"] = temp_std
+        row["vib_avg_win"] = vib_avg
+        row["vib_std_win"] = vib_std
+        row["window_size"] = args.window  # failure_flag is set when flushing
+
+        # Buffer row (we'll label & publish after a small delay to catch 'FAILED right after')
+        pending_rows[m_id].append(row)
+
+        # Attempt to flush rows that are old enough
+        finalize_flushable_rows(m_id, current_tick=tick)
 
     def on_message(client, userdata, msg):
         topic = msg.topic
-        s = msg.payload.decode("utf-8", errors="replace")
         try:
-            obj = json.loads(s)
-        except json.JSONDecodeError:
+            obj = loads(msg.payload)
+        except ValueError:
+            s = msg.payload.decode("utf-8", errors="replace")
             print(f"[WARN] Non-JSON on {topic}: {s[:120]}", file=sys.stderr)
             return
 
@@ -183,86 +369,11 @@ def main():
 
         # -------- TELEMETRY --------
         elif topic == TELEM_TOPIC:
-            m_id = obj.get("machine_id")
-            if not m_id:
-                return
+            handle_telemetry(obj)
 
-            ts_raw   = obj.get("timestamp", datetime.now(tz=timezone.utc).isoformat().replace("+00:00","Z"))
-            epoch_ms = to_epoch_ms(ts_raw)
-            tick     = tick_from_ts(ts_raw)
-            cls      = obj.get("class_name") or (status_cache.get(m_id) or {}).get("class_name")
-            seq      = obj.get("seq")
-
-            # Raw signals (only temp & vibration as requested)
-            temp = obj.get("temperature_c") or obj.get("temperature") or obj.get("temp")
-            vib  = obj.get("vibration_rms_mm_s") or obj.get("vibration")
-
-            # Thresholds
-            t_thresh = (status_cache.get(m_id) or {}).get("temp_threshold")
-            v_thresh = (status_cache.get(m_id) or {}).get("vib_threshold")
-
-            # Deltas & dt
-            dt_s, d_temp, d_vib = None, None, None
-            if m_id in prev_point:
-                dt_s = (epoch_ms - prev_point[m_id]["epoch_ms"]) / 1000.0
-                if temp is not None and prev_point[m_id]["temp"] is not None:
-                    try: d_temp = float(temp) - float(prev_point[m_id]["temp"])
-                    except Exception: d_temp = None
-                if vib is not None and prev_point[m_id]["vib"] is not None:
-                    try: d_vib = float(vib) - float(prev_point[m_id]["vib"])
-                    except Exception: d_vib = None
-            prev_point[m_id] = {"epoch_ms": epoch_ms, "tick": tick, "temp": temp, "vib": vib}
-
-            # Rolling stats
-            if temp is not None: roll[m_id]["temp"].append(float(temp))
-            if vib  is not None: roll[m_id]["vib"].append(float(vib))
-            temp_avg = (sum(roll[m_id]["temp"]) / len(roll[m_id]["temp"])) if roll[m_id]["temp"] else None
-            vib_avg  = (sum(roll[m_id]["vib"])  / len(roll[m_id]["vib"]))  if roll[m_id]["vib"] else None
-            temp_std = std_of(roll[m_id]["temp"]) if roll[m_id]["temp"] else None
-            vib_std  = std_of(roll[m_id]["vib"])  if roll[m_id]["vib"] else None
-
-            # Normalized to thresholds
-            pct_temp = None
-            if temp is not None and t_thresh not in (None, 0):
-                try: pct_temp = float(temp) / float(t_thresh)
-                except Exception: pct_temp = None
-
-            pct_vib = None
-            if vib is not None and v_thresh not in (None, 0):
-                try: pct_vib = float(vib) / float(v_thresh)
-                except Exception: pct_vib = None
-
-            row = {
-                "timestamp_iso": mk_iso(epoch_ms),
-                "epoch_ms": epoch_ms,
-                "tick": tick,
-                "machine_id": m_id,
-                "class_name": cls,
-                "seq": seq,
-                "temperature_c": float(temp) if temp is not None else None,
-                "vibration_rms_mm_s": float(vib) if vib is not None else None,
-                "temp_threshold": float(t_thresh) if t_thresh not in (None, "") else None,
-                "vib_threshold": float(v_thresh) if v_thresh not in (None, "") else None,
-                "dt_seconds": float(dt_s) if dt_s is not None else None,
-                "d_temp": float(d_temp) if d_temp is not None else None,
-                "d_vibration": float(d_vib) if d_vib is not None else None,
-                "pct_of_temp_thresh": float(pct_temp) if pct_temp is not None else None,
-                "pct_of_vib_thresh": float(pct_vib) if pct_vib is not None else None,
-                "temp_avg_win": float(temp_avg) if temp_avg is not None else None,
-                "temp_std_win": float(temp_std) if temp_std is not None else None,
-                "vib_avg_win": float(vib_avg) if vib_avg is not None else None,
-                "vib_std_win": float(vib_std) if vib_std is not None else None,
-                "failure_flag": None,  # set when flushing
-                "window_size": args.window,
-                "edge_version": EDGE_VERSION,
-                "source": "edge"
-            }
-
-            # Buffer row (we'll label & publish after a small delay to catch 'FAILED right after')
-            pending_rows[m_id].append(row)
-
-            # Attempt to flush rows that are old enough
-            finalize_flushable_rows(m_id, current_tick=tick)
+        elif topic == TELEM_BATCH_TOPIC:
+            for item in obj.get("items") or ():
+                handle_telemetry(item)
 
         # -------- EVENTS (labels) --------
         elif topic == EVENTS_TOPIC:
@@ -271,21 +382,30 @@ def main():
                 m_id = obj.get("machine_id")
                 if m_id:
                     t = tick_from_ts(obj.get("timestamp"))
-                    failure_ticks[m_id].add(t)
+                    recent = failure_ticks[m_id]
+                    recent.append(t)
+                    while recent[0] < t - fail_horizon:
+                        recent.popleft()
 
-        # Optional console pretty-print (trim noisy payloads)
-        now = datetime.now().strftime("%H:%M:%S")
-        preview = obj if isinstance(obj, dict) else str(obj)[:120]
-        print(f"[{now}] Topic: {topic} | Keys: {list(obj.keys()) if isinstance(obj, dict) else 'N/A'}")
-        sys.stdout.flush()
+        # Optional console log (--verbose)
+        if args.verbose:
+            now = time.strftime("%H:%M:%S")
+            print(f"[{now}] Topic: {topic} | Keys: {list(obj.keys()) if isinstance(obj, dict) else 'N/A'}")
 
     # MQTT wiring
     client = mqtt.Client(client_id=f"edge-publisher-{int(datetime.now().timestamp())}")
     client.on_connect = on_connect
     client.on_message = on_message
+    # Publish-heavy client: more QoS>0 messages in flight, a deep outgoing queue, quick reconnects
+    client.max_inflight_messages_set(100)
+    client.max_queued_messages_set(10000)
+    client.reconnect_delay_set(min_delay=1, max_delay=8)
 
     # Reasonable defaults for an edge device
-    client.will_set(PUBLISH_TOPIC, json.dumps({"edge_version": EDGE_VERSION, "status": "offline"}), qos=0, retain=False)
+    # Offline notice goes to the topic rows are published on, in the same wire format
+    will = {"edge_version": EDGE_VERSION, "status": "offline"}
+    will_payload = msgpack.packb(will) if args.encoding == "msgpack" else json.dumps(will)
+    client.will_set(out_topic, will_payload, qos=0, retain=False)
 
     client.connect(args.broker, args.port, keepalive=60)
 
@@ -295,16 +415,14 @@ def main():
         print("\n[MQTT] Shutting down…")
         # On shutdown, flush everything left in buffers with best-effort labels
         for m_id, rows in pending_rows.items():
-            for row in rows:
+            fails = set(failure_ticks.get(m_id, ()))
+            while rows:
+                row = rows.popleft()
                 t = row["tick"]
-                fails = failure_ticks[m_id]
                 label = 1 if (t in fails or (t + 1) in fails) else 0
                 row["failure_flag"] = label
                 # publish all remaining rows
-                payload = json.dumps(row, separators=(",", ":"), ensure_ascii=False)
-                client.publish(PUBLISH_TOPIC, payload, qos=args.qos, retain=args.retain)
-                if args.csv:
-                    append_csv(args.csv, csv_fields, row)
+                publish_row(row)
         client.disconnect()
 
 if __name__ == "__main__":
@@ -21,6 +21,19 @@ except Exception:
     linear_sum_assignment = None
     _HAS_SCIPY = False
 
+try:
+    # Jonker-Volgenant (LAPJV): faster than scipy on the small square matrices used here
+    from lap import lapjv
+    _HAS_LAP = True
+except Exception:
+    lapjv = None
+    _HAS_LAP = False
+
+
+# Scratch L1/L2 matrices reused across run_iha calls, grown to the largest k
+# seen so far (schedulers call run_iha from a single thread).
+_BUF = {"k": 0, "L1": None, "L2": None}
+
 
 # ---------------- Utility Functions ---------------- #
 
@@ -31,13 +44,35 @@ def _safe_array_min_max(arr):
     return min(flat), max(flat)
 
 
+def _float_attr(obj, name):
+    try:
+        return float(getattr(obj, name, 0.0))
+    except Exception:
+        return 0.0
+
+
+def _cost_buffers(k, fill):
+    if k > _BUF["k"]:
+        _BUF["L1"] = np.empty((k, k), dtype=float)
+        _BUF["L2"] = np.empty((k, k), dtype=float)
+        _BUF["k"] = k
+    L1 = _BUF["L1"][:k, :k]
+    L2 = _BUF["L2"][:k, :k]
+    L1.fill(fill)
+    L2.fill(fill)
+    return L1, L2
+
+
 def _normalize_matrix(mat, eps=1e-9):
     if np is not None and isinstance(mat, np.ndarray):
         mn = float(np.nanmin(mat))
-        mx = float(np.nanmax(mat))
-        if abs(mx - mn) < eps:
+        rng = float(np.nanmax(mat)) - mn
+        if abs(rng) < eps:
             return np.zeros_like(mat)
-        return (mat - mn) / (mx - mn)
+        # one temporary, scaled in place (avoids a second k*k pass/allocation)
+        out = mat - mn
+        out /= rng
+        return out
     else:
         mn, mx = _safe_array_min_max([v for row in mat for v in row])
         if abs(mx - mn) < eps:
@@ -97,59 +132,74 @@ def run_iha(
     if n_jobs == 0 or n_machs == 0:
         return []
 
+    # Pull each objective once per entity (not once per matrix cell)
+    flow = [_float_attr(job, "remaining_ticks_on_step") for job in job_list]
+    work = [_float_attr(mach, "temperature") + _float_attr(mach, "vibration")
+            for mach in mach_list]
+
+    # A constant objective adds the same cost to every complete assignment
+    # (real cells all share one value, padding cells another), so drop it;
+    # with both constant any pairing is optimal and no solve is needed.
+    flow_flat = max(flow) - min(flow) < 1e-9
+    work_flat = max(work) - min(work) < 1e-9
+    if flow_flat and work_flat:
+        return [(job_list[i], mach_list[i]) for i in range(min(n_jobs, n_machs))]
+
+    # Build cost matrices: L1 varies by job (row), L2 by machine (column);
+    # padding cells of the square matrix keep the eps cost.
     k = max(n_jobs, n_machs)  # ensure square matrix
     if np is not None:
-        L1 = np.full((k, k), eps, dtype=float)
-        L2 = np.full((k, k), eps, dtype=float)
+        L1, L2 = _cost_buffers(k, eps)
+        L1[:n_jobs, :n_machs] = np.asarray(flow, dtype=np.float64)[:, None]
+        L2[:n_jobs, :n_machs] = np.asarray(work, dtype=np.float64)[None, :]
     else:
         L1 = [[eps] * k for _ in range(k)]
         L2 = [[eps] * k for _ in range(k)]
-
-    # Build cost matrices
-    for i, job in enumerate(job_list):
-        for j, mach in enumerate(mach_list):
-            try:
-                t_flow = float(getattr(job, "remaining_ticks_on_step", 0.0))
-            except Exception:
-                t_flow = 0.0
-            try:
-                temp = float(getattr(mach, "temperature", 0.0))
-            except Exception:
-                temp = 0.0
-            try:
-                vib = float(getattr(mach, "vibration", 0.0))
-            except Exception:
-                vib = 0.0
-
-            workload = temp + vib
-            if np is not None:
-                L1[i, j] = t_flow
-                L2[i, j] = workload
-            else:
-                L1[i][j] = t_flow
-                L2[i][j] = workload
-
-    # Normalize
-    L1n = _normalize_matrix(L1)
-    L2n = _normalize_matrix(L2)
+        for i in range(n_jobs):
+            for j in range(n_machs):
+                L1[i][j] = flow[i]
+                L2[i][j] = work[j]
 
     w1, w2 = float(weights[0]), float(weights[1])
     wsum = (w1 + w2) if (w1 + w2) != 0 else 1.0
     w1 /= wsum
     w2 /= wsum
 
-    if np is not None and isinstance(L1n, np.ndarray):
-        L = w1 * L1n + w2 * L2n
+    # Normalize (only the objectives that vary)
+    L1n = None if flow_flat else _normalize_matrix(L1)
+    L2n = None if work_flat else _normalize_matrix(L2)
+
+    if np is not None and isinstance(L1, np.ndarray):
+        # L1n/L2n are fresh arrays owned here, so combine them in place
+        if L2n is None:
+            L1n *= w1
+            L = L1n
+        elif L1n is None:
+            L2n *= w2
+            L = L2n
+        else:
+            L1n *= w1
+            L2n *= w2
+            L1n += L2n
+            L = L1n
+    elif L2n is None:
+        L = [[w1 * v for v in row] for row in L1n]
+    elif L1n is None:
+        L = [[w2 * v for v in row] for row in L2n]
     else:
         L = [
             [w1 * L1n[i][j] + w2 * L2n[i][j] for j in range(k)]
             for i in range(k)
         ]
 
-    # Solve assignment
-    if _HAS_SCIPY and np is not None:
+    # Solve assignment (LAPJV if available, else scipy, else greedy)
+    if (_HAS_LAP or _HAS_SCIPY) and np is not None:
         try:
-            row_ind, col_ind = linear_sum_assignment(L)
+            if _HAS_LAP:
+                _, col_ind, _ = lapjv(L)
+                row_ind = range(k)
+            else:
+                row_ind, col_ind = linear_sum_assignment(L)
         except Exception:
             row_ind, col_ind = _greedy_assignment(L, k, k)
     else:
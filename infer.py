@@ -1,18 +1,34 @@
 # infer.py
+import argparse
 import json
 import os
+import threading
 from datetime import datetime
-from collections import defaultdict, deque
+from collections import defaultdict
 
 import joblib
+import numpy as np
 import pandas as pd
 import paho.mqtt.client as mqtt
 
+from onnx_session import load_session
+from rolling_stats import RollingStats
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Parses MQTT payload bytes directly (no intermediate str); both raise ValueError
+loads = orjson.loads if orjson is not None else json.loads
+
 STATUS_TOPIC = "job/status"
 TELEM_TOPIC  = "job/telemetry"
+TELEM_BATCH_TOPIC = "job/telemetry/batch"   # {"t": tick, "items": [telemetry, ...]}
 ALERT_TOPIC  = "job/alerts"
 
 MODEL_PATH = "failure_rf.pkl"
+ONNX_PATH  = "failure_rf.onnx"   # optional; written by `python infer.py --export-onnx`
 META_PATH  = "model_meta.json"
 
 # ---- Load model and tuned threshold ----
@@ -30,18 +46,36 @@ if os.path.exists(META_PATH):
 else:
     print(f"[MODEL] {META_PATH} not found. Using default threshold {THRESHOLD:.3f}")
 
+# ---- Model input layout (training column order) ----
+FEATURE_ORDER = (
+    "temperature_c", "vibration_rms_mm_s", "temp_threshold", "vib_threshold",
+    "dt_seconds", "d_temp", "d_vibration", "pct_of_temp_thresh", "pct_of_vib_thresh",
+    "temp_avg_win", "temp_std_win", "vib_avg_win", "vib_std_win", "class_name",
+)
+CLASS_MAP = {"A": 0, "B": 1, "C": 2, "D": 3}
+
+# Estimators fitted on a DataFrame (named columns, string class_name) expose
+# feature_names_in_ and still need a frame; anything else gets a float matrix.
+_FRAME_INPUT = hasattr(model, "feature_names_in_")
+
+# ---- Optional ONNX Runtime session (compiled tree ensemble) ----
+session, _ORT_PROBA = load_session(ONNX_PATH, MODEL_PATH)
+
+# ---- Batched inference ----
+FLUSH_INTERVAL_S = 0.1   # max time a telemetry row waits for a prediction
+FLUSH_MAX_ROWS   = 64    # wake the flusher early once this many rows are pending
+
+_pending = []            # [(machine_id, feature_row), ...] awaiting predict_proba
+_pending_lock = threading.Lock()
+_wake = threading.Event()
+_X = np.empty((FLUSH_MAX_ROWS, len(FEATURE_ORDER)), dtype=np.float64)  # reused input buffer
+
 # ---- Runtime state from status topic ----
 status = {}  # machine_id -> {class_name, temp_threshold, vib_threshold}
 
 # ---- Live feature state (match training features) ----
 prev = {}  # machine_id -> {"ts_ms": int, "temp": float, "vib": float}
-roll = defaultdict(lambda: {"temp": deque(maxlen=5), "vib": deque(maxlen=5)})
-
-def std_of(buf):
-    n = len(buf)
-    if n < 2: return 0.0
-    m = sum(buf)/n
-    return (sum((x-m)**2 for x in buf)/(n-1))**0.5
+roll = defaultdict(lambda: {"temp": RollingStats(5), "vib": RollingStats(5)})
 
 def to_epoch_ms(ts):
     # Accept numeric tick or ISO8601
@@ -61,12 +95,13 @@ def on_connect(client, userdata, flags, rc, properties=None):
     print("Connected" if rc == 0 else f"Failed rc={rc}")
     client.subscribe(STATUS_TOPIC, qos=0)
     client.subscribe(TELEM_TOPIC, qos=0)
+    client.subscribe(TELEM_BATCH_TOPIC, qos=0)
 
 def on_message(client, userdata, msg):
     topic = msg.topic
     try:
-        o = json.loads(msg.payload.decode("utf-8", "replace"))
-    except json.JSONDecodeError:
+        o = loads(msg.payload)
+    except ValueError:
         return
 
     # 1) Cache status
@@ -81,89 +116,172 @@ def on_message(client, userdata, msg):
         }
         return
 
-    # 2) Telemetry -> compute features -> predict -> publish alert
+    # 2) Telemetry -> compute features -> queue for prediction
     if topic == TELEM_TOPIC:
-        m_id = o.get("machine_id")
-        if not m_id:
-            return
+        on_telemetry(o)
+    elif topic == TELEM_BATCH_TOPIC:
+        for item in o.get("items") or ():
+            on_telemetry(item)
 
-        sc = status.get(m_id, {})
-        t_thresh = sc.get("temp_threshold")
-        v_thresh = sc.get("vib_threshold")
-
-        # Raw signals (match training names)
-        temp = o.get("temperature_c") or o.get("temperature") or o.get("temp")
-        vib  = o.get("vibration_rms_mm_s") or o.get("vibration")
-
-        # Timestamp / tick if present; else use now
-        ts = o.get("timestamp", datetime.utcnow().isoformat() + "Z")
-        epoch_ms = to_epoch_ms(ts)
-
-        # Deltas and dt
-        dt_s = d_temp = d_vib = None
-        if m_id in prev:
-            dt_s = (epoch_ms - prev[m_id]["ts_ms"]) / 1000.0
-            if temp is not None and prev[m_id]["temp"] is not None:
-                try: d_temp = float(temp) - float(prev[m_id]["temp"])
-                except Exception: d_temp = None
-            if vib is not None and prev[m_id]["vib"] is not None:
-                try: d_vib = float(vib) - float(prev[m_id]["vib"])
-                except Exception: d_vib = None
-        prev[m_id] = {"ts_ms": epoch_ms, "temp": temp, "vib": vib}
-
-        # Rolling stats (window=5 like training)
-        if temp is not None:
-            try: roll[m_id]["temp"].append(float(temp))
-            except Exception: pass
-        if vib is not None:
-            try: roll[m_id]["vib"].append(float(vib))
-            except Exception: pass
-        temp_avg = (sum(roll[m_id]["temp"])/len(roll[m_id]["temp"])) if roll[m_id]["temp"] else None
-        vib_avg  = (sum(roll[m_id]["vib"])/len(roll[m_id]["vib"]))   if roll[m_id]["vib"]  else None
-        temp_std = std_of(roll[m_id]["temp"]) if roll[m_id]["temp"] else None
-        vib_std  = std_of(roll[m_id]["vib"])  if roll[m_id]["vib"]  else None
-
-        # Normalized to thresholds
-        pct_temp = None
-        if temp is not None and t_thresh not in (None, 0):
-            try: pct_temp = float(temp)/float(t_thresh)
-            except Exception: pct_temp = None
-
-        pct_vib = None
-        if vib is not None and v_thresh not in (None, 0):
-            try: pct_vib = float(vib)/float(v_thresh)
-            except Exception: pct_vib = None
-
-        # Build the exact model row (same columns as training)
-        row = {
-            "temperature_c":        temp,
-            "vibration_rms_mm_s":   vib,
-            "temp_threshold":       t_thresh,
-            "vib_threshold":        v_thresh,
-            "dt_seconds":           dt_s,
-            "d_temp":               d_temp,
-            "d_vibration":          d_vib,
-            "pct_of_temp_thresh":   pct_temp,
-            "pct_of_vib_thresh":    pct_vib,
-            "temp_avg_win":         temp_avg,
-            "temp_std_win":         temp_std,
-            "vib_avg_win":          vib_avg,
-            "vib_std_win":          vib_std,
-            "class_name":           sc.get("class_name") or o.get("class_name"),
-        }
+def on_telemetry(o):
+    """Features for one telemetry reading (a job/telemetry message or a batch item)."""
+    m_id = o.get("machine_id")
+    if not m_id:
+        return
+
+    # Per-machine state, looked up once per message
+    sc = status.get(m_id, {})
+    pp = prev.get(m_id)
+    rolls = roll[m_id]
+    rt, rv = rolls["temp"], rolls["vib"]
+    t_thresh = sc.get("temp_threshold")
+    v_thresh = sc.get("vib_threshold")
+
+    # Raw signals (match training names)
+    temp = o.get("temperature_c") or o.get("temperature") or o.get("temp")
+    vib  = o.get("vibration_rms_mm_s") or o.get("vibration")
+
+    # Timestamp / tick if present; else use now
+    ts = o.get("timestamp", datetime.utcnow().isoformat() + "Z")
+    epoch_ms = to_epoch_ms(ts)
 
-        # Predict probability
-        X = pd.DataFrame([row])
+    # Deltas and dt
+    dt_s = d_temp = d_vib = None
+    if pp is not None:
+        dt_s = (epoch_ms - pp["ts_ms"]) / 1000.0
+        if temp is not None and pp["temp"] is not None:
+            try: d_temp = float(temp) - float(pp["temp"])
+            except Exception: d_temp = None
+        if vib is not None and pp["vib"] is not None:
+            try: d_vib = float(vib) - float(pp["vib"])
+            except Exception: d_vib = None
+    prev[m_id] = {"ts_ms": epoch_ms, "temp": temp, "vib": vib}
+
+    # Rolling stats (window=5 like training)
+    if temp is not None:
+        try: rt.append(float(temp))
+        except Exception: pass
+    if vib is not None:
+        try: rv.append(float(vib))
+        except Exception: pass
+    temp_avg = rt.avg
+    vib_avg  = rv.avg
+    temp_std = rt.std
+    vib_std  = rv.std
+
+    # Normalized to thresholds
+    pct_temp = None
+    if temp is not None and t_thresh not in (None, 0):
+        try: pct_temp = float(temp)/float(t_thresh)
+        except Exception: pct_temp = None
+
+    pct_vib = None
+    if vib is not None and v_thresh not in (None, 0):
+        try: pct_vib = float(vib)/float(v_thresh)
+        except Exception: pct_vib = None
+
+    # Build the exact model row (FEATURE_ORDER, same columns as training)
+    row = (
+        temp, vib, t_thresh, v_thresh,
+        dt_s, d_temp, d_vib, pct_temp, pct_vib,
+        temp_avg, temp_std, vib_avg, vib_std,
+        sc.get("class_name") or o.get("class_name"),
+    )
+
+    # Queue for the next batched prediction (see flush_pending)
+    with _pending_lock:
+        _pending.append((m_id, row))
+        n_pending = len(_pending)
+    if n_pending >= FLUSH_MAX_ROWS:
+        _wake.set()
+
+# Input building stays local: sim_common fills float32 rows straight from Machine
+# objects, while these rows come off the wire and may hold None (or non-numeric
+# strings) that must be converted per value.
+def _model_input(rows):
+    """Turn FEATURE_ORDER tuples into what the model was fitted on."""
+    if _FRAME_INPUT:
+        return pd.DataFrame.from_records(rows, columns=FEATURE_ORDER)
+    global _X
+    n = len(rows)
+    if n > len(_X):
+        _X = np.empty((n, len(FEATURE_ORDER)), dtype=np.float64)
+    X = _X[:n]
+    nan = np.nan
+    for i, r in enumerate(rows):
+        X[i, :-1] = [nan if v is None else float(v) for v in r[:-1]]
+        X[i, -1] = CLASS_MAP.get(r[-1], nan)
+    return X
+
+def _onnx_feeds(rows):
+    """ONNX inputs: one column tensor per feature for frame models, else a float32 matrix."""
+    if not _FRAME_INPUT:
+        return {"input": _model_input(rows).astype(np.float32)}
+    n = len(rows)
+    feeds = {}
+    for j, name in enumerate(FEATURE_ORDER[:-1]):
+        feeds[name] = np.fromiter((np.nan if r[j] is None else float(r[j]) for r in rows),
+                                  dtype=np.float32, count=n).reshape(n, 1)
+    feeds["class_name"] = np.array([[r[-1] or ""] for r in rows], dtype=object)
+    return feeds
+
+def predict_risk(rows):
+    """Failure probability for each FEATURE_ORDER row."""
+    if session is not None:
+        return session.run([_ORT_PROBA], _onnx_feeds(rows))[0][:, 1]
+    return model.predict_proba(_model_input(rows))[:, 1]
+
+def export_onnx(dst=ONNX_PATH):
+    """Offline: convert the loaded model for ONNX Runtime (needs skl2onnx)."""
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType, StringTensorType
+
+    if _FRAME_INPUT:
+        types = [(c, StringTensorType([None, 1]) if c == "class_name" else FloatTensorType([None, 1]))
+                 for c in FEATURE_ORDER]
+    else:
+        types = [("input", FloatTensorType([None, len(FEATURE_ORDER)]))]
+    clf = model.steps[-1][1] if hasattr(model, "steps") else model
+    onx = convert_sklearn(model, initial_types=types, options={id(clf): {"zipmap": False}})
+    with open(dst, "wb") as f:
+        f.write(onx.SerializeToString())
+    print(f"[MODEL] Wrote {dst}")
+
+def _predict_each(batch):
+    """Score (machine_id, row) pairs separately; rows that fail are logged and dropped."""
+    kept, probs = [], []
+    for m_id, row in batch:
         try:
-            prob = float(model.predict_proba(X)[0, 1])
+            prob = predict_risk([row])[0]
         except Exception as e:
             print(f"[INFER] Predict failed for {m_id}: {e}")
+            continue
+        kept.append((m_id, row))
+        probs.append(prob)
+    return kept, probs
+
+def flush_pending(client):
+    """Score every pending row with a single predict_proba call and publish alerts."""
+    global _pending
+    with _pending_lock:
+        if not _pending:
             return
+        batch, _pending = _pending, []
+
+    try:
+        probs = predict_risk([row for _, row in batch])
+    except Exception as e:
+        # One bad reading must not cost the rest of the window its alerts
+        print(f"[INFER] Predict failed for batch of {len(batch)}: {e}. Scoring rows one by one")
+        batch, probs = _predict_each(batch)
 
+    ts = datetime.utcnow().isoformat() + "Z"
+    for (m_id, _), prob in zip(batch, probs):
+        prob = float(prob)
         red_flag = prob >= THRESHOLD
 
         alert = {
-            "timestamp":  datetime.utcnow().isoformat() + "Z",
+            "timestamp":  ts,
             "machine_id": m_id,
             "model":      "rf_v1",
             "risk_score": prob,
@@ -174,16 +292,38 @@ def on_message(client, userdata, msg):
         if red_flag:
             print(f"[ALERT] FAIL PREDICTED → machine={m_id} | risk={prob:.3f} (thr={THRESHOLD:.3f})")
 
+def _flush_loop(client, stop):
+    # Single consumer: predictions never run concurrently with each other
+    while not stop.is_set():
+        _wake.wait(FLUSH_INTERVAL_S)
+        _wake.clear()
+        flush_pending(client)
+
 def main():
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect("localhost", 1883, 60)
+
+    stop = threading.Event()
+    flusher = threading.Thread(target=_flush_loop, args=(client, stop), daemon=True)
+    flusher.start()
     try:
         client.loop_forever()
     except KeyboardInterrupt:
         print("\n[MQTT] Shutting down…")
+        stop.set()
+        _wake.set()
+        flusher.join()
+        flush_pending(client)
         client.disconnect()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Live failure-risk scoring of machine telemetry")
+    parser.add_argument("--export-onnx", action="store_true",
+                        help=f"Write {ONNX_PATH} for ONNX Runtime scoring and exit (needs skl2onnx)")
+    args = parser.parse_args()
+    if args.export_onnx:
+        export_onnx()
+    else:
+        main()
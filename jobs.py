@@ -1,10 +1,17 @@
 import itertools
 import random
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+try:
+    import numpy as np
+except Exception:
+    np = None
 
 _job_id_counter = itertools.count(1)
 
+_INV60 = 1.0 / 60.0  # hours per tick (1 tick = 1 minute)
+
 INTENSITIES = {
     "light":    {"temp_inc": 3.0, "vib_inc": 0.8, "power_kw": 1.8},
     "moderate": {"temp_inc": 4.5, "vib_inc": 1.2, "power_kw": 2.6},
@@ -22,11 +29,21 @@ ROUTE_PATTERNS = [
     ["A", "A", "B"],
 ]
 
+# Import-time snapshots for the per-job random picks
+_INTENSITY_ITEMS = tuple(INTENSITIES.items())
+_ROUTE_PATTERNS = tuple(ROUTE_PATTERNS)
+
 DURATION_TOTAL_RANGE = (8, 18)
 REDUCTION_RANGE = (0.2, 0.6)  # reduction percentage range
 
+# Typed lookups for Job.make_batch
+if np is not None:
+    _POWER_KW = np.array([inc["power_kw"] for _, inc in _INTENSITY_ITEMS], dtype=np.float64)
+    _PATTERN_LENS = np.array([len(p) for p in _ROUTE_PATTERNS], dtype=np.intp)
+    _MAX_STEPS = int(_PATTERN_LENS.max())
+
 
-@dataclass
+@dataclass(slots=True)
 class Job:
     job_id: str
     intensity: str
@@ -35,43 +52,50 @@ class Job:
     power_kw: float
     reduction: float = 0.0  # cooling reduction factor
 
-    # Each step: (machine_class, remaining_ticks, power_kw)
-    steps: List[Tuple[str, int, float]] = field(default_factory=list)
+    # Route as parallel per-step lists: machine_class, remaining_ticks, power_kw
+    step_class: List[str] = field(default_factory=list)
+    step_ticks: List[int] = field(default_factory=list)
+    step_power: List[float] = field(default_factory=list)
     current_step: int = 0
     energy_used: float = 0.0  # total energy (kWh-equivalent)
 
+    @property
+    def steps(self) -> List[Tuple[str, int, float]]:
+        """(machine_class, remaining_ticks, power_kw) per step; read-only view."""
+        return list(zip(self.step_class, self.step_ticks, self.step_power))
+
     @property
     def done(self) -> bool:
-        return self.current_step >= len(self.steps)
+        return self.current_step >= len(self.step_ticks)
 
     @property
     def required_class(self) -> str:
         if self.done:
             return ""
-        return self.steps[self.current_step][0]
+        return self.step_class[self.current_step]
 
     @property
     def remaining_ticks_on_step(self) -> int:
         if self.done:
             return 0
-        return self.steps[self.current_step][1]
+        return self.step_ticks[self.current_step]
 
     @property
     def current_power_kw(self) -> float:
         if self.done:
             return 0.0
-        return self.steps[self.current_step][2]
+        return self.step_power[self.current_step]
 
     def work_one_tick(self) -> None:
         """Simulate one tick of work and accumulate energy usage."""
         if self.done:
             return
-        cls_name, rem, pwr = self.steps[self.current_step]
-        rem -= 1
-        self.energy_used += pwr * (1 / 60)  # assuming 1 tick = 1 minute
-        self.steps[self.current_step] = (cls_name, rem, pwr)
+        i = self.current_step
+        rem = self.step_ticks[i] - 1
+        self.step_ticks[i] = rem
+        self.energy_used += self.step_power[i] * _INV60
         if rem <= 0:
-            self.current_step += 1
+            self.current_step = i + 1
 
     def put_back_unfinished_step_front(self) -> None:
         """Keep current step intact; no reordering needed."""
@@ -80,20 +104,20 @@ class Job:
     @classmethod
     def make_random(cls) -> "Job":
         jid = f"JOB_{next(_job_id_counter)}"
-        intensity = random.choice(list(INTENSITIES.keys()))
-        inc = INTENSITIES[intensity]
+        intensity, inc = random.choice(_INTENSITY_ITEMS)
 
-        pattern = random.choice(ROUTE_PATTERNS)
+        pattern = random.choice(_ROUTE_PATTERNS)
         total = random.randint(*DURATION_TOTAL_RANGE)
 
-        base = [2] * len(pattern)
-        remaining = max(0, total - sum(base))
-        for _ in range(remaining):
-            base[random.randrange(len(base))] += 1
+        n_steps = len(pattern)
+        base = [2] * n_steps
+        randrange = random.randrange
+        for _ in range(max(0, total - 2 * n_steps)):
+            base[randrange(n_steps)] += 1
 
         # Assign random per-step power variation (±20%)
-        steps = [(cls_name, dur, inc["power_kw"] * random.uniform(0.8, 1.2))
-                 for cls_name, dur in zip(pattern, base)]
+        uniform, power_kw = random.uniform, inc["power_kw"]
+        powers = [power_kw * uniform(0.8, 1.2) for _ in pattern]
 
         reduction_factor = random.uniform(*REDUCTION_RANGE)
 
@@ -103,21 +127,68 @@ class Job:
             temp_inc=inc["temp_inc"],
             vib_inc=inc["vib_inc"],
             power_kw=inc["power_kw"],
-            steps=steps,
+            step_class=list(pattern),
+            step_ticks=base,
+            step_power=powers,
             reduction=reduction_factor,
         )
 
+    @classmethod
+    def make_batch(cls, n: int, rng: Optional["np.random.Generator"] = None) -> List["Job"]:
+        """
+        n random jobs (same distributions as make_random), drawn with a few
+        array calls for the whole batch. Without numpy, falls back to make_random.
+        """
+        if np is None:
+            return [cls.make_random() for _ in range(n)]
+        if n <= 0:
+            return []
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))  # follows random.seed()
+
+        lo, hi = DURATION_TOTAL_RANGE
+        intensity_idx = rng.integers(len(_INTENSITY_ITEMS), size=n)
+        pattern_idx = rng.integers(len(_ROUTE_PATTERNS), size=n)
+        totals = rng.integers(lo, hi + 1, size=n)
+        reductions = rng.uniform(*REDUCTION_RANGE, size=n)
+        jitters = rng.uniform(0.8, 1.2, size=(n, _MAX_STEPS))
+
+        # 2 ticks per step, then each extra tick lands on a uniformly chosen step
+        lens = _PATTERN_LENS[pattern_idx]
+        extra = np.maximum(0, totals - 2 * lens)
+        picks = (rng.random((n, hi)) * lens[:, None]).astype(np.intp)
+        used = np.arange(hi) < extra[:, None]
+        ticks = np.full((n, _MAX_STEPS), 2, dtype=np.intp)
+        np.add.at(ticks, (np.nonzero(used)[0], picks[used]), 1)
+        powers = _POWER_KW[intensity_idx][:, None] * jitters
+
+        jobs = []
+        for i, (ii, pi, n_steps, red) in enumerate(zip(intensity_idx.tolist(), pattern_idx.tolist(),
+                                                       lens.tolist(), reductions.tolist())):
+            intensity, inc = _INTENSITY_ITEMS[ii]
+            jobs.append(cls(
+                job_id=f"JOB_{next(_job_id_counter)}",
+                intensity=intensity,
+                temp_inc=inc["temp_inc"],
+                vib_inc=inc["vib_inc"],
+                power_kw=inc["power_kw"],
+                step_class=list(_ROUTE_PATTERNS[pi]),
+                step_ticks=ticks[i, :n_steps].tolist(),
+                step_power=powers[i, :n_steps].tolist(),
+                reduction=red,
+            ))
+        return jobs
+
     @classmethod
     def make(cls, intensity: str) -> "Job":
         jid = f"JOB_{next(_job_id_counter)}"
         inc = INTENSITIES[intensity]
-        pattern = random.choice(ROUTE_PATTERNS)
+        pattern = random.choice(_ROUTE_PATTERNS)
         total = random.randint(*DURATION_TOTAL_RANGE)
         base = [2] * len(pattern)
         remaining = max(0, total - sum(base))
         for _ in range(remaining):
             base[random.randrange(len(base))] += 1
-        steps = [(cls_name, dur, inc["power_kw"]) for cls_name, dur in zip(pattern, base)]
         reduction_factor = random.uniform(*REDUCTION_RANGE)
         return cls(
             job_id=jid,
@@ -125,6 +196,8 @@ class Job:
             temp_inc=inc["temp_inc"],
             vib_inc=inc["vib_inc"],
             power_kw=inc["power_kw"],
-            steps=steps,
+            step_class=list(pattern),
+            step_ticks=base,
+            step_power=[inc["power_kw"]] * len(pattern),
             reduction=reduction_factor,
         )
@@ -2,10 +2,56 @@
 import json
 import random
 from dataclasses import dataclass, field
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 from jobs import Job
+from rolling_stats import RollingStats
 
-@dataclass
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+
+def _dumps(obj) -> str:
+    """Compact JSON text (orjson when installed, same separators either way)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+_INV60 = 1.0 / 60.0  # hours per tick (1 tick = 1 minute)
+
+NOISE_CHUNK = 4096  # busy-tick draws generated per refill
+
+
+def _busy_noise() -> Iterator[Tuple[float, float, float, float]]:
+    """
+    Endless (temp_noise, vib_noise, temp_spike, vib_spike) draws for one busy tick.
+    Spikes are 0.0 unless the 7% spike fires. With numpy the draws are made in
+    bulk chunks, seeded from `random` so random.seed() still reproduces a run.
+    """
+    if np is None:
+        while True:
+            yield (random.uniform(-1.0, 1.4), random.uniform(-0.4, 0.6),
+                   random.uniform(2.0, 6.0) if random.random() < 0.07 else 0.0,
+                   random.uniform(0.8, 2.0) if random.random() < 0.07 else 0.0)
+    while True:
+        rng = np.random.default_rng(random.getrandbits(64))
+        n = NOISE_CHUNK
+        t_noise = rng.uniform(-1.0, 1.4, n)
+        v_noise = rng.uniform(-0.4, 0.6, n)
+        t_spike = np.where(rng.random(n) < 0.07, rng.uniform(2.0, 6.0, n), 0.0)
+        v_spike = np.where(rng.random(n) < 0.07, rng.uniform(0.8, 2.0, n), 0.0)
+        yield from zip(t_noise.tolist(), v_noise.tolist(), t_spike.tolist(), v_spike.tolist())
+
+
+_noise = _busy_noise()
+
+@dataclass(slots=True)
 class Machine:
     """
     Digital Twin Enabled Machine: class-based routing + failure/repair.
@@ -23,6 +69,18 @@ class Machine:
     busy_with: Optional[Job] = field(default=None, init=False)
     repairing_left: int = field(default=0, init=False)
     total_power_kwh: float = field(default=0.0, init=False)
+    # status_json cache: everything after "timestamp", keyed by the fields that change
+    _status_key: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+    _status_tail: str = field(default="", init=False, repr=False, compare=False)
+    # repair-edge tracking set by the simulation loop (declared: no __dict__ with slots)
+    was_repairing: bool = field(default=False, init=False, repr=False, compare=False)
+    # RF feature history kept by the simulators' feature builder: previous
+    # reading (feat_prev_ts_ms -1 until the first one) and the 5-sample windows
+    feat_prev_ts_ms: int = field(default=-1, init=False, repr=False, compare=False)
+    feat_prev_temp: float = field(default=0.0, init=False, repr=False, compare=False)
+    feat_prev_vib: float = field(default=0.0, init=False, repr=False, compare=False)
+    feat_temp: RollingStats = field(default_factory=lambda: RollingStats(5), init=False, repr=False, compare=False)
+    feat_vib: RollingStats = field(default_factory=lambda: RollingStats(5), init=False, repr=False, compare=False)
     
 
     def __post_init__(self):
@@ -38,79 +96,94 @@ class Machine:
         return self.operational and self.busy_with is None
 
     def assign(self, job: Job) -> bool:
-        if not self.idle:
+        if self.repairing_left or self.busy_with is not None:
             return False
         if job.required_class != self.class_name:
             return False
         # --- reduction logic ---
-        # Compute difference from base values
-        temp_diff = self.temperature - self.temp_base
-        vib_diff  = self.vibration - self.vib_base
-
-        reduction = getattr(job, "reduction", 0.0)  # fallback safe
-
-        # Reduce current readings by that percentage of the excess
+        # Reduce current readings by that percentage of the excess over base
+        reduction = job.reduction
         if reduction > 0:
-            self.temperature -= temp_diff * reduction
-            self.vibration  -= vib_diff * reduction
+            temp = self.temperature
+            vib = self.vibration
+            self.temperature = temp - (temp - self.temp_base) * reduction
+            self.vibration  = vib - (vib - self.vib_base) * reduction
 
         # Now assign the job
         self.busy_with = job
         return True
 
+    def preempt(self) -> Optional[Job]:
+        """
+        Predicted failure: take the machine down for repair before it fails.
+        Returns the job it was running (its current step left intact) so the
+        caller can requeue it at the front, or None if it was idle.
+        """
+        j = self.busy_with
+        if j is not None:
+            j.put_back_unfinished_step_front()
+            self.busy_with = None
+        self.repairing_left = self.repair_time
+        return j
+
     # --- helpers ---
     def _cooldown(self):
         self.temperature = max(self.temp_base, self.temperature - 1.2)
         self.vibration  = max(self.vib_base,  self.vibration  - 0.25)
 
-    def _maybe_spike(self):
-        # small random spikes to occasionally cross thresholds
-        if random.random() < 0.07:
-            self.temperature += random.uniform(2.0, 6.0)
-        if random.random() < 0.07:
-            self.vibration  += random.uniform(0.8, 2.0)
-
     # --- tick ---
     def step(self) -> Tuple[Optional[str], Optional[Job]]:
         """
         Returns (event, data): event in {None, "FAILED", "STEP_DONE", "COMPLETED"}
         """
-        if self.repairing_left > 0:
-            self.repairing_left -= 1
-            if self.repairing_left == 0:
+        left = self.repairing_left
+        if left > 0:
+            left -= 1
+            self.repairing_left = left
+            if left == 0:
                 self.temperature = self.temp_base
                 self.vibration  = self.vib_base
             return None, None
 
-        if self.busy_with:
-            j = self.busy_with
-            # apply job load + noise
-            self.temperature += j.temp_inc + random.uniform(-1.0, 1.4)
-            self.vibration  += j.vib_inc  + random.uniform(-0.4, 0.6)
-            power_kw = getattr(j, "current_power_kw", 0.0)
-            self.total_power_kwh += power_kw * (1 / 60)  # assuming 1 tick = 1 minute
-            self._maybe_spike()
+        j = self.busy_with
+        if j:
+            # current step, read once (a busy job always has one left)
+            idx = j.current_step
+            ticks = j.step_ticks
+            rem = ticks[idx]
+            kwh = j.step_power[idx] * _INV60
+            # numeric core on locals: job load + noise, then small random spikes
+            # to occasionally cross thresholds; written back once
+            t_noise, v_noise, t_spike, v_spike = next(_noise)
+            temp = self.temperature + (j.temp_inc + t_noise) + t_spike
+            vib  = self.vibration  + (j.vib_inc  + v_noise) + v_spike
+            self.total_power_kwh += kwh
+            self.temperature = temp
+            self.vibration = vib
             # thresholds
-            if self.temperature >= self.temp_threshold or self.vibration >= self.vib_threshold:
+            if temp >= self.temp_threshold or vib >= self.vib_threshold:
                 # Return the job so the simulation can requeue to FRONT of same-class queue
-                failed_job = self.busy_with
-                failed_job.put_back_unfinished_step_front()
+                j.put_back_unfinished_step_front()
                 self.busy_with = None
                 self.repairing_left = self.repair_time
-                return "FAILED", failed_job
-
-            before = j.remaining_ticks_on_step
-            j.work_one_tick()
-
-            if j.done:
-                finished = j
+                return "FAILED", j
+
+            # one tick of work (same bookkeeping as Job.work_one_tick)
+            j.energy_used += kwh
+            rem_after = rem - 1
+            ticks[idx] = rem_after
+            if rem_after > 0:
+                return None, None
+
+            nxt = idx + 1
+            j.current_step = nxt
+            if nxt >= len(ticks):  # job done
                 self.busy_with = None
-                return "COMPLETED", finished
+                return "COMPLETED", j
 
-            if before == 1:  # just finished a step (moved to next step)
-                step_done = j
+            if rem == 1:  # just finished a step (moved to next step)
                 self.busy_with = None
-                return "STEP_DONE", step_done
+                return "STEP_DONE", j
 
             return None, None
 
@@ -129,16 +202,23 @@ class Machine:
             status = "Operational"
             current_job = "IDLE"
 
-        doc = {
-            "timestamp": timestamp,
-            "machine_id": self.machine_id,
-            "class_name": self.class_name,
-            "temperature": round(self.temperature, 2),
-            "vibration": round(self.vibration, 2),
-            "status": status,
-            "current_job": current_job,  # never null
-            "temp_threshold": self.temp_threshold,
-            "vib_threshold": self.vib_threshold,
-            "power_kwh_total": round(self.total_power_kwh, 3),
-        }
-        return json.dumps(doc)
+        temperature = round(self.temperature, 2)
+        vibration = round(self.vibration, 2)
+        power = round(self.total_power_kwh, 3)
+        key = (status, current_job, temperature, vibration, power)
+        if key != self._status_key:
+            doc = {
+                "machine_id": self.machine_id,
+                "class_name": self.class_name,
+                "temperature": temperature,
+                "vibration": vibration,
+                "status": status,
+                "current_job": current_job,  # never null
+                "temp_threshold": self.temp_threshold,
+                "vib_threshold": self.vib_threshold,
+                "power_kwh_total": power,
+            }
+            self._status_key = key
+            self._status_tail = _dumps(doc)[1:]
+        ts = str(timestamp) if type(timestamp) is int else _dumps(timestamp)
+        return '{"timestamp":' + ts + "," + self._status_tail
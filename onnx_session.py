@@ -0,0 +1,30 @@
+# onnx_session.py
+# Optional ONNX Runtime session for the exported failure model
+# (written by `python infer.py --export-onnx`); shared by infer.py and sim_common.py.
+import os
+
+try:
+    import onnxruntime as ort
+except Exception:
+    ort = None
+
+
+def load_session(onnx_path: str, model_path: str):
+    """
+    (session, probability output name) for onnx_path, or (None, None) when
+    onnxruntime or the file is missing or the model fails to load, in which
+    case the caller keeps scoring with the sklearn model at model_path.
+    Single-threaded: every batch is a handful of rows.
+    """
+    if ort is None or not os.path.exists(onnx_path):
+        return None, None
+    try:
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = 1
+        session = ort.InferenceSession(onnx_path, opts, providers=["CPUExecutionProvider"])
+        proba = session.get_outputs()[1].name  # [label, probabilities] with zipmap off
+    except Exception as e:
+        print(f"[MODEL] Could not load {onnx_path}: {e}. Using {model_path}")
+        return None, None
+    print(f"[MODEL] Using ONNX Runtime model {onnx_path}")
+    return session, proba
@@ -1,17 +1,55 @@
 # reader.py
 import argparse
 import json
+import multiprocessing as mp
+import queue
+import signal
 import sys
 import csv
+import functools
 import os
+import time
 from datetime import datetime
 from collections import defaultdict, deque
 import paho.mqtt.client as mqtt
 
+from rolling_stats import RollingStats
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Parses MQTT payload bytes directly (no intermediate str); both raise ValueError
+loads = orjson.loads if orjson is not None else json.loads
+
+def pretty(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+    return json.dumps(obj, indent=2, sort_keys=True)
+
 STATUS_TOPIC = "job/status"
 TELEM_TOPIC  = "job/telemetry"
+TELEM_BATCH_TOPIC = "job/telemetry/batch"   # {"t": tick, "items": [telemetry, ...]}
 EVENTS_TOPIC = "jobshop/status"
 
+CSV_FLUSH_ROWS = 256   # flush the CSV handle after this many rows...
+CSV_FLUSH_S    = 2.0   # ...or once this many seconds have passed since the last flush
+QUEUE_MAX      = 10000 # MQTT -> worker backlog; messages beyond this are dropped
+
+_EMPTY = {}  # shared stand-in for a machine with no cached status (never mutated)
+
+# ----------------- console clock -----------------
+_clock = {"sec": -1, "text": ""}
+
+def clock_hms():
+    """Local HH:MM:SS for log lines, formatted at most once per second."""
+    s = int(time.time())
+    if s != _clock["sec"]:
+        _clock["sec"] = s
+        _clock["text"] = time.strftime("%H:%M:%S", time.localtime(s))
+    return _clock["text"]
+
 # ----------------- CSV helpers -----------------
 def ensure_header(path, fieldnames):
     exists = os.path.exists(path) and os.path.getsize(path) > 0
@@ -20,67 +58,74 @@ def ensure_header(path, fieldnames):
             w = csv.DictWriter(f, fieldnames=fieldnames)
             w.writeheader()
 
-def append_csv(path, fieldnames, row):
-    out = {k: row.get(k, None) for k in fieldnames}
-    with open(path, "a", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writerow(out)
-
 # ----------------- time utils -----------------
-def to_epoch_ms(ts):
-    # Accept ints (ticks) or ISO8601 strings
+def _now_ms():
+    return int(datetime.utcnow().timestamp() * 1000)
+
+@functools.lru_cache(maxsize=4096)
+def _parse_ts(s):
+    """(tick, epoch_ms) for a numeric or ISO8601 string, None if unparseable; cached per string."""
     try:
-        return int(float(ts) * 1000)  # numeric tick => seconds → ms
-    except Exception:
+        f = float(s)
+        return int(f), int(f * 1000)
+    except (ValueError, OverflowError):
         pass
     try:
-        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
-        return int(dt.timestamp() * 1000)
-    except Exception:
-        return int(datetime.utcnow().timestamp() * 1000)
+        ms = int(datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return None
+    return ms // 1000, ms
+
+def to_epoch_ms(ts):
+    # Accept ints (ticks) or ISO8601 strings; numbers skip parsing entirely
+    t = type(ts)
+    if t is int:
+        return ts * 1000  # numeric tick => seconds → ms
+    if t is float:
+        try:
+            return int(ts * 1000)
+        except (ValueError, OverflowError):
+            return _now_ms()
+    parsed = _parse_ts(str(ts))
+    return parsed[1] if parsed is not None else _now_ms()
 
 def mk_iso(epoch_ms):
     return datetime.utcfromtimestamp(epoch_ms/1000).isoformat() + "Z"
 
 def tick_from_ts(ts):
     # Prefer integer tick if provided; otherwise derive from epoch seconds
-    try:
-        return int(float(ts))
-    except Exception:
-        return int(to_epoch_ms(ts) // 1000)
-
-# ----------------- stats -----------------
-def std_of(buf):
-    n = len(buf)
-    if n < 2:
-        return 0.0
-    mean = sum(buf)/n
-    var = sum((x - mean) ** 2 for x in buf) / (n - 1)
-    return var ** 0.5
-
-# ----------------- main -----------------
-def main():
-    parser = argparse.ArgumentParser(description="MQTT → single CSV with features + labels")
-    parser.add_argument("--broker", default="localhost")
-    parser.add_argument("--port", type=int, default=1883)
-    parser.add_argument("--topics", nargs="*", default=[STATUS_TOPIC, TELEM_TOPIC, EVENTS_TOPIC],
-                        help="Topics to subscribe (space-separated)")
-    parser.add_argument("--csv", default="training_data.csv", help="Output CSV path")
-    parser.add_argument("--window", type=int, default=5, help="Rolling window (samples) per machine")
-    parser.add_argument("--flush_delay", type=int, default=1,
-                        help="Ticks to wait before finalizing a telemetry row to catch 'FAILED at/after'")
-    args = parser.parse_args()
+    t = type(ts)
+    if t is int:
+        return ts
+    if t is float:
+        try:
+            return int(ts)
+        except (ValueError, OverflowError):
+            return _now_ms() // 1000
+    parsed = _parse_ts(str(ts))
+    return parsed[0] if parsed is not None else _now_ms() // 1000
+
+# ----------------- worker -----------------
+def consume(q, args):
+    """
+    Worker process: parse, build features, label and write CSV for every
+    (topic, payload) taken off `q`, until the None sentinel arrives.
+    """
+    # Ctrl-C reaches the whole process group; the parent stops us with the sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     # Caches
     status_cache = {}        # machine_id -> {"class_name", "temp_threshold", "vib_threshold"}
     prev_point   = {}        # machine_id -> {"epoch_ms", "tick", "temp", "vib"}
-    roll = defaultdict(lambda: {"temp": deque(maxlen=args.window), "vib": deque(maxlen=args.window)})
+    roll = defaultdict(lambda: {"temp": RollingStats(args.window), "vib": RollingStats(args.window)})
 
     # Pending telemetry rows (not flushed yet) to allow labeling with near-future events
-    pending_rows = defaultdict(list)  # machine_id -> [row_dict,...]
+    pending_rows = deque()  # (machine_id, row) for all machines, in arrival (tick) order
 
     # Failure events by machine & tick
-    failure_ticks = defaultdict(set)  # machine_id -> {tick_int, ...}
+    failure_ticks = defaultdict(deque)  # machine_id -> recent tick_ints, oldest first
+    # Failures older than this can no longer label a pending row
+    fail_horizon = max(64, args.flush_delay + 2)
 
     # Final CSV schema
     fields = [
@@ -93,42 +138,144 @@ def main():
         "failure_flag"
     ]
     ensure_header(args.csv, fields)
-
-    # -------- MQTT callbacks --------
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("[MQTT] Connected")
-            for t in args.topics:
-                client.subscribe(t, qos=0)
-                print(f"[MQTT] Subscribed: {t}")
-        else:
-            print(f"[MQTT] Connect failed rc={rc}")
-
-    def finalize_flushable_rows(machine_id, current_tick):
+    # Rows are plain lists in `fields` order
+    FIELD_INDEX = {name: i for i, name in enumerate(fields)}
+    TICK_IDX = FIELD_INDEX["tick"]
+    FLAG_IDX = FIELD_INDEX["failure_flag"]
+
+    # One handle + writer for the whole run; rows go out per flushed batch
+    csv_file = open(args.csv, "a", newline="")
+    writer = csv.writer(csv_file)
+    csv_state = {"rows": 0, "last_flush": time.monotonic()}
+
+    def write_rows(rows):
+        writer.writerows(rows)
+        csv_state["rows"] += len(rows)
+        now = time.monotonic()
+        if csv_state["rows"] >= CSV_FLUSH_ROWS or now - csv_state["last_flush"] >= CSV_FLUSH_S:
+            csv_file.flush()
+            csv_state["rows"] = 0
+            csv_state["last_flush"] = now
+
+    def label_row(row, fails):
+        row_tick = row[TICK_IDX]
+        row[FLAG_IDX] = 1 if fails and (row_tick in fails or (row_tick + 1) in fails) else 0
+
+    def write_labeled(pairs):
+        """Label (machine_id, row) pairs from the failures seen so far and write them."""
+        fail_sets = {}  # machine_id -> failure tick set, built once per call
+        ready = []
+        for m_id, row in pairs:
+            fails = fail_sets.get(m_id)
+            if fails is None:
+                fails = fail_sets[m_id] = set(failure_ticks.get(m_id, ()))
+            label_row(row, fails)
+            ready.append(row)
+        write_rows(ready)
+
+    def finalize_flushable_rows(current_tick):
         """
-        Flush rows whose tick is <= current_tick - flush_delay.
+        Flush rows (any machine) whose tick is <= current_tick - flush_delay.
         Label as 1 if FAILED at same tick or the immediate next tick.
         """
-        if machine_id not in pending_rows:
+        if not pending_rows:
+            return
+        if current_tick < pending_rows[0][1][TICK_IDX]:
+            # Ticks went backwards (simulator restarted, or a second one publishing):
+            # every row queued before the newest one is stale and would hold it back
+            newest = pending_rows.pop()
+            write_labeled(pending_rows)
+            pending_rows.clear()
+            pending_rows.append(newest)
+
+        # Otherwise rows arrive in tick order, so the flushable ones are a prefix
+        cutoff = current_tick - args.flush_delay
+        if pending_rows[0][1][TICK_IDX] > cutoff:
+            return
+        ready = []
+        while pending_rows and pending_rows[0][1][TICK_IDX] <= cutoff:
+            ready.append(pending_rows.popleft())
+        write_labeled(ready)
+
+    def handle_telemetry(obj):
+        """One telemetry reading: a job/telemetry message or an item of a batch."""
+        m_id = obj.get("machine_id")
+        if not m_id:
             return
-        keep = []
-        for row in pending_rows[machine_id]:
-            row_tick = row["tick"]
-            if row_tick <= (current_tick - args.flush_delay):
-                fails = failure_ticks[machine_id]
-                label = 1 if (row_tick in fails or (row_tick + 1) in fails) else 0
-                row["failure_flag"] = label
-                append_csv(args.csv, fields, row)
-            else:
-                keep.append(row)
-        pending_rows[machine_id] = keep
 
-    def on_message(client, userdata, msg):
-        topic = msg.topic
-        s = msg.payload.decode("utf-8", errors="replace")
+        # Per-machine state, looked up once per message
+        sc = status_cache.get(m_id) or _EMPTY
+        pp = prev_point.get(m_id)
+
+        ts_raw = obj["timestamp"] if "timestamp" in obj else datetime.utcnow().isoformat() + "Z"
+        epoch_ms = to_epoch_ms(ts_raw)
+        tick = tick_from_ts(ts_raw)
+        cls = obj.get("class_name") or sc.get("class_name")
+        seq = obj.get("seq")
+
+        # Raw signals (only temp & vibration as requested)
+        temp = obj.get("temperature_c") or obj.get("temperature") or obj.get("temp")
+        vib  = obj.get("vibration_rms_mm_s") or obj.get("vibration")
+
+        # Thresholds
+        t_thresh = sc.get("temp_threshold")
+        v_thresh = sc.get("vib_threshold")
+
+        # Deltas & dt
+        dt_s, d_temp, d_vib = None, None, None
+        if pp is not None:
+            dt_s = (epoch_ms - pp["epoch_ms"]) / 1000.0
+            if temp is not None and pp["temp"] is not None:
+                try: d_temp = float(temp) - float(pp["temp"])
+                except Exception: d_temp = None
+            if vib is not None and pp["vib"] is not None:
+                try: d_vib = float(vib) - float(pp["vib"])
+                except Exception: d_vib = None
+        prev_point[m_id] = {"epoch_ms": epoch_ms, "tick": tick, "temp": temp, "vib": vib}
+
+        # Rolling stats (O(1) per sample, see rolling_stats.py)
+        rolls = roll[m_id]
+        rt, rv = rolls["temp"], rolls["vib"]
+        if temp is not None: rt.append(float(temp))
+        if vib  is not None: rv.append(float(vib))
+        temp_avg = rt.avg
+        vib_avg  = rv.avg
+        temp_std = rt.std
+        vib_std  = rv.std
+
+        # Normalized to thresholds
+        pct_temp = None
+        if temp is not None and t_thresh not in (None, 0):
+            try: pct_temp = float(temp) / float(t_thresh)
+            except Exception: pct_temp = None
+
+        pct_vib = None
+        if vib is not None and v_thresh not in (None, 0):
+            try: pct_vib = float(vib) / float(v_thresh)
+            except Exception: pct_vib = None
+
+        # Same order as `fields`
+        row = [
+            mk_iso(epoch_ms), epoch_ms, tick, m_id, cls, seq,
+            temp, vib,
+            t_thresh, v_thresh,
+            dt_s, d_temp, d_vib,
+            pct_temp, pct_vib,
+            temp_avg, temp_std, vib_avg, vib_std,
+            None,  # failure_flag, set when flushing
+        ]
+
+        # Buffer row (we'll label & flush after a small delay to catch 'FAILED right after')
+        pending_rows.append((m_id, row))
+
+        # Attempt to flush rows that are old enough
+        finalize_flushable_rows(current_tick=tick)
+
+    def handle(topic, payload):
         try:
-            obj = json.loads(s)
-        except json.JSONDecodeError:
+            obj = loads(payload)
+        except ValueError:
+            s = payload.decode("utf-8", errors="replace")
             print(f"[WARN] Non-JSON on {topic}: {s[:120]}", file=sys.stderr)
             return
 
@@ -145,83 +292,11 @@ def main():
 
         # -------- TELEMETRY --------
         elif topic == TELEM_TOPIC:
-            m_id = obj.get("machine_id")
-            if not m_id:
-                return
+            handle_telemetry(obj)
 
-            ts_raw = obj.get("timestamp", datetime.utcnow().isoformat()+"Z")
-            epoch_ms = to_epoch_ms(ts_raw)
-            tick = tick_from_ts(ts_raw)
-            cls = obj.get("class_name") or (status_cache.get(m_id) or {}).get("class_name")
-            seq = obj.get("seq")
-
-            # Raw signals (only temp & vibration as requested)
-            temp = obj.get("temperature_c") or obj.get("temperature") or obj.get("temp")
-            vib  = obj.get("vibration_rms_mm_s") or obj.get("vibration")
-
-            # Thresholds
-            t_thresh = (status_cache.get(m_id) or {}).get("temp_threshold")
-            v_thresh = (status_cache.get(m_id) or {}).get("vib_threshold")
-
-            # Deltas & dt
-            dt_s, d_temp, d_vib = None, None, None
-            if m_id in prev_point:
-                dt_s = (epoch_ms - prev_point[m_id]["epoch_ms"]) / 1000.0
-                if temp is not None and prev_point[m_id]["temp"] is not None:
-                    try: d_temp = float(temp) - float(prev_point[m_id]["temp"])
-                    except Exception: d_temp = None
-                if vib is not None and prev_point[m_id]["vib"] is not None:
-                    try: d_vib = float(vib) - float(prev_point[m_id]["vib"])
-                    except Exception: d_vib = None
-            prev_point[m_id] = {"epoch_ms": epoch_ms, "tick": tick, "temp": temp, "vib": vib}
-
-            # Rolling stats
-            if temp is not None: roll[m_id]["temp"].append(float(temp))
-            if vib  is not None: roll[m_id]["vib"].append(float(vib))
-            temp_avg = (sum(roll[m_id]["temp"]) / len(roll[m_id]["temp"])) if roll[m_id]["temp"] else None
-            vib_avg  = (sum(roll[m_id]["vib"])  / len(roll[m_id]["vib"]))  if roll[m_id]["vib"] else None
-            temp_std = std_of(roll[m_id]["temp"]) if roll[m_id]["temp"] else None
-            vib_std  = std_of(roll[m_id]["vib"])  if roll[m_id]["vib"] else None
-
-            # Normalized to thresholds
-            pct_temp = None
-            if temp is not None and t_thresh not in (None, 0):
-                try: pct_temp = float(temp) / float(t_thresh)
-                except Exception: pct_temp = None
-
-            pct_vib = None
-            if vib is not None and v_thresh not in (None, 0):
-                try: pct_vib = float(vib) / float(v_thresh)
-                except Exception: pct_vib = None
-
-            row = {
-                "timestamp_iso": mk_iso(epoch_ms),
-                "epoch_ms": epoch_ms,
-                "tick": tick,
-                "machine_id": m_id,
-                "class_name": cls,
-                "seq": seq,
-                "temperature_c": temp,
-                "vibration_rms_mm_s": vib,
-                "temp_threshold": t_thresh,
-                "vib_threshold": v_thresh,
-                "dt_seconds": dt_s,
-                "d_temp": d_temp,
-                "d_vibration": d_vib,
-                "pct_of_temp_thresh": pct_temp,
-                "pct_of_vib_thresh": pct_vib,
-                "temp_avg_win": temp_avg,
-                "temp_std_win": temp_std,
-                "vib_avg_win": vib_avg,
-                "vib_std_win": vib_std,
-                "failure_flag": None,  # set when flushing
-            }
-
-            # Buffer row (we'll label & flush after a small delay to catch 'FAILED right after')
-            pending_rows[m_id].append(row)
-
-            # Attempt to flush rows that are old enough
-            finalize_flushable_rows(m_id, current_tick=tick)
+        elif topic == TELEM_BATCH_TOPIC:
+            for item in obj.get("items") or ():
+                handle_telemetry(item)
 
         # -------- EVENTS (labels) --------
         elif topic == EVENTS_TOPIC:
@@ -230,33 +305,88 @@ def main():
                 m_id = obj.get("machine_id")
                 if m_id:
                     t = tick_from_ts(obj.get("timestamp"))
-                    failure_ticks[m_id].add(t)
+                    recent = failure_ticks[m_id]
+                    recent.append(t)
+                    while recent[0] < t - fail_horizon:
+                        recent.popleft()
 
-        # Optional console pretty-print
-        now = datetime.now().strftime("%H:%M:%S")
-        print(f"\n[{now}] Topic: {topic}")
-        print(json.dumps(obj, indent=2, sort_keys=True))
-        sys.stdout.flush()
+        # Optional console pretty-print (--verbose)
+        if args.verbose:
+            print(f"\n[{clock_hms()}] Topic: {topic}")
+            print(pretty(obj))
+
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            handle(*item)
+    finally:
+        # On shutdown, flush everything left in buffers with best-effort labels
+        write_labeled(pending_rows)
+        csv_file.close()
+
+# ----------------- main -----------------
+def main():
+    parser = argparse.ArgumentParser(description="MQTT → single CSV with features + labels")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--topics", nargs="*", default=[STATUS_TOPIC, TELEM_TOPIC, TELEM_BATCH_TOPIC, EVENTS_TOPIC],
+                        help="Topics to subscribe (space-separated)")
+    parser.add_argument("--csv", default="training_data.csv", help="Output CSV path")
+    parser.add_argument("--window", type=int, default=5, help="Rolling window (samples) per machine")
+    parser.add_argument("--flush_delay", type=int, default=1,
+                        help="Ticks to wait before finalizing a telemetry row to catch 'FAILED at/after'")
+    parser.add_argument("--verbose", action="store_true", help="Pretty-print every incoming message")
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    # MQTT thread only enqueues raw payloads; features + CSV I/O run in the worker
+    q = mp.Queue(maxsize=QUEUE_MAX)
+    worker = mp.Process(target=consume, args=(q, args), name="reader-worker")
+    worker.start()
+
+    # -------- MQTT callbacks --------
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            print("[MQTT] Connected")
+            for t in args.topics:
+                client.subscribe(t, qos=0)
+                print(f"[MQTT] Subscribed: {t}")
+        else:
+            print(f"[MQTT] Connect failed rc={rc}")
+
+    q_state = {"dropped": 0}
+
+    def on_message(client, userdata, msg):
+        try:
+            q.put_nowait((msg.topic, msg.payload))
+        except queue.Full:
+            q_state["dropped"] += 1
+            n = q_state["dropped"]
+            if n == 1 or n % 1000 == 0:
+                print(f"[WARN] Worker backlog full, dropped {n} message(s)", file=sys.stderr)
 
     # MQTT wiring
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(args.broker, args.port, keepalive=60)
+    client.loop_start()
 
     try:
-        client.loop_forever()
+        while worker.is_alive():
+            worker.join(1.0)
+        print("[WARN] Worker exited unexpectedly", file=sys.stderr)
     except KeyboardInterrupt:
         print("\n[MQTT] Shutting down…")
-        # On shutdown, flush everything left in buffers with best-effort labels
-        for m_id, rows in pending_rows.items():
-            for row in rows:
-                t = row["tick"]
-                fails = failure_ticks[m_id]
-                label = 1 if (t in fails or (t + 1) in fails) else 0
-                row["failure_flag"] = label
-                append_csv(args.csv, fields, row)
+    finally:
+        client.loop_stop()
         client.disconnect()
+        if worker.is_alive():
+            q.put(None)
+            worker.join()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
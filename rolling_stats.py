@@ -0,0 +1,83 @@
+# rolling_stats.py
+"""
+Rolling Window Statistics
+-------------------------
+Per-signal sliding window (last N samples) with O(1) mean and sample
+standard deviation, maintained with Welford's update on every append and
+the matching removal step for the sample that falls out of the window.
+Samples live unboxed in a preallocated array('d') ring, so appends do not
+allocate. The running sums are rebuilt from the ring once per window
+length of appends, which bounds floating-point drift at amortized O(1) cost.
+Used for the *_avg_win / *_std_win features.
+"""
+
+from array import array
+from typing import Optional
+
+
+class RollingStats:
+    """Sliding window of the last `window` samples with running mean / M2."""
+
+    __slots__ = ("buf", "cap", "n", "i", "mean", "_m2", "_since_sync")
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError(f"window must be >= 1, got {window}")
+        self.buf = array("d", bytes(8 * window))
+        self.cap = window
+        self.n = 0   # samples held
+        self.i = 0   # next write slot (oldest sample once full)
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._since_sync = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, x: float) -> None:
+        buf, i, cap = self.buf, self.i, self.cap
+        if self.n == cap:
+            self._remove(buf[i])
+        else:
+            self.n += 1
+        buf[i] = x
+        self.i = i + 1 if i + 1 < cap else 0
+        self._since_sync += 1
+        if self._since_sync >= cap:
+            self._resync()
+            return
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    def _resync(self) -> None:
+        # Unfilled slots only exist before the first wrap, and always at the tail
+        vals = self.buf if self.n == self.cap else self.buf[:self.n]
+        mean = sum(vals) / self.n
+        self.mean = mean
+        self._m2 = sum((v - mean) ** 2 for v in vals)
+        self._since_sync = 0
+
+    def _remove(self, x: float) -> None:
+        n = self.n - 1  # samples left once x is gone
+        if n == 0:
+            self.mean = 0.0
+            self._m2 = 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / n
+        self._m2 -= delta * (x - self.mean)
+
+    @property
+    def avg(self) -> Optional[float]:
+        return self.mean if self.n else None
+
+    @property
+    def std(self) -> Optional[float]:
+        """Sample std (ddof=1); 0.0 for a single sample, None when empty."""
+        n = self.n
+        if n == 0:
+            return None
+        if n < 2:
+            return 0.0
+        return (max(self._m2, 0.0) / (n - 1)) ** 0.5
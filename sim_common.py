@@ -0,0 +1,207 @@
+# sim_common.py
+# Shared by simulation.py (tick runner) and simpy_simulation.py: topics, the
+# failure model and its feature builder, and the threaded MQTT sender.
+import json
+import os
+import queue
+import threading
+from typing import List
+
+import numpy as np
+import pandas as pd
+import joblib
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+from machines import Machine
+from onnx_session import load_session
+
+
+TOPIC_JOB_STATUS     = "job/status"
+TOPIC_JOBSHOP        = "jobshop/status"
+TOPIC_TELEMETRY_BATCH = "job/telemetry/batch"   # {"t": tick, "items": [telemetry, ...]}
+
+
+def dumps(obj) -> bytes:
+    """Compact JSON bytes for publish() (orjson when installed)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+# --- Load ML model + threshold ---
+MODEL_PATH = "failure_rf.pkl"
+ONNX_PATH  = "failure_rf.onnx"   # optional; written by `python infer.py --export-onnx`
+META_PATH  = "model_meta.json"
+
+model = joblib.load(MODEL_PATH)
+
+# Optional ONNX Runtime session (compiled tree ensemble)
+session, _ORT_PROBA = load_session(ONNX_PATH, MODEL_PATH)
+THRESHOLD = 0.5
+if os.path.exists(META_PATH):
+    try:
+        with open(META_PATH, "r") as f:
+            meta = json.load(f)
+        THRESHOLD = float(meta.get("chosen_threshold", meta.get("best_f1_threshold", THRESHOLD)))
+        print(f"[MODEL] Loaded threshold from meta: {THRESHOLD:.3f}")
+    except Exception as e:
+        print(f"[MODEL] Could not read {META_PATH}: {e}. Using default {THRESHOLD:.3f}")
+else:
+    print(f"[MODEL] {META_PATH} not found. Using default threshold {THRESHOLD:.3f}")
+
+# optional conservative bump to reduce early preemptions on cold start
+if THRESHOLD < 0.32:
+    THRESHOLD = 0.32
+
+# --- Feature builder ---
+# Per-machine history (previous reading, rolling windows) lives on each Machine (feat_* fields)
+
+FEATURE_COLUMNS = (
+    "temperature_c", "vibration_rms_mm_s", "temp_threshold", "vib_threshold",
+    "dt_seconds", "d_temp", "d_vibration", "pct_of_temp_thresh", "pct_of_vib_thresh",
+    "temp_avg_win", "temp_std_win", "vib_avg_win", "vib_std_win", "class_name",
+)
+CLASS_MAP = {"A": 0, "B": 1, "C": 2, "D": 3}
+
+# Pipelines fitted on a DataFrame (named columns, string class_name) still need
+# a frame in their own column order; anything else takes the float matrix.
+_FRAME_INPUT = hasattr(model, "feature_names_in_")
+_FRAME_COLUMNS = list(model.feature_names_in_) if _FRAME_INPUT else None
+
+# A fitted tree-ensemble classifier (bare, or a pipeline's last step) is scored by
+# averaging its trees directly, like its own predict_proba minus the per-call
+# validation and joblib dispatch; any other model goes through predict_proba.
+_forest = model.steps[-1][1] if hasattr(model, "steps") else model
+_TREES = list(getattr(_forest, "estimators_", ()))
+if not _TREES or getattr(_forest, "n_outputs_", 0) != 1 \
+        or not all(hasattr(t, "predict_proba") for t in _TREES):
+    _TREES = None
+_PRE = model[:-1] if _TREES is not None and hasattr(model, "steps") else None
+
+def _forest_proba(X: np.ndarray) -> np.ndarray:
+    """Mean of the trees' class probabilities; X is float32 and C-contiguous."""
+    out = np.zeros((X.shape[0], _forest.n_classes_), dtype=np.float64)
+    for tree in _TREES:
+        out += tree.predict_proba(X, check_input=False)
+    out /= len(_TREES)
+    return out
+
+# Reused input rows in FEATURE_COLUMNS order; class_name is stored as its CLASS_MAP code.
+# float32 is what the trees compare in, so neither backend needs a converted copy.
+_X = np.empty((8, len(FEATURE_COLUMNS)), dtype=np.float32)
+
+def build_features_batch(machines: List[Machine], t: int) -> np.ndarray:
+    """Fill one FEATURE_COLUMNS row per machine (same order); returns a view of _X."""
+    global _X
+    n = len(machines)
+    if n > len(_X):
+        _X = np.empty((n, len(FEATURE_COLUMNS)), dtype=np.float32)
+    X = _X[:n]
+    nan = np.nan
+    ts_ms = int(t * 1000)
+    for i, m in enumerate(machines):
+        temp = m.temperature
+        vib = m.vibration
+        t_thresh = m.temp_threshold
+        v_thresh = m.vib_threshold
+
+        dt_s = d_temp = d_vib = nan
+        if m.feat_prev_ts_ms >= 0:
+            dt_s = (ts_ms - m.feat_prev_ts_ms) / 1000.0
+            d_temp = temp - m.feat_prev_temp
+            d_vib = vib - m.feat_prev_vib
+        m.feat_prev_ts_ms = ts_ms
+        m.feat_prev_temp = temp
+        m.feat_prev_vib = vib
+
+        rt, rv = m.feat_temp, m.feat_vib
+        rt.append(temp)
+        rv.append(vib)
+
+        X[i] = (
+            temp, vib, t_thresh, v_thresh,
+            dt_s, d_temp, d_vib,
+            temp / t_thresh if t_thresh else nan,
+            vib / v_thresh if v_thresh else nan,
+            rt.avg, rt.std, rv.avg, rv.std,
+            CLASS_MAP.get(m.class_name, nan),
+        )
+
+    return X
+
+def _model_input(X: np.ndarray, machines: List[Machine]):
+    """What the sklearn model was fitted on: the matrix itself, or a frame."""
+    if not _FRAME_INPUT:
+        return X
+    cols = {c: X[:, j] for j, c in enumerate(FEATURE_COLUMNS[:-1])}
+    cols["class_name"] = [m.class_name for m in machines]
+    return pd.DataFrame(cols, columns=_FRAME_COLUMNS)
+
+def _onnx_feeds(X: np.ndarray, machines: List[Machine]):
+    """ONNX inputs: one column tensor per feature for frame models, else a float32 matrix."""
+    if not _FRAME_INPUT:
+        return {"input": X}
+    feeds = {c: np.ascontiguousarray(X[:, j:j + 1]) for j, c in enumerate(FEATURE_COLUMNS[:-1])}
+    feeds["class_name"] = np.array([[m.class_name] for m in machines], dtype=object)
+    return feeds
+
+def predict_risk(machines: List[Machine], t: int, mask=None) -> np.ndarray:
+    """
+    Build this tick's features for every machine (so each one's history advances)
+    and return the failure probability of those selected by mask (default: all).
+    """
+    X = build_features_batch(machines, t)
+    if mask is not None:
+        machines = [m for m, keep in zip(machines, mask) if keep]
+        if not machines:
+            return np.empty(0)
+        X = X[mask]
+    if session is not None:
+        return session.run([_ORT_PROBA], _onnx_feeds(X, machines))[0][:, 1]
+    if _TREES is not None:
+        if _PRE is not None:
+            Xt = _PRE.transform(_model_input(X, machines))
+            X = np.ascontiguousarray(Xt.toarray() if hasattr(Xt, "toarray") else Xt, dtype=np.float32)
+        return _forest_proba(X)[:, 1]
+    return model.predict_proba(_model_input(X, machines))[:, 1]
+
+
+class MqttSender:
+    """
+    Outbound MQTT: the sim loop only enqueues; one sender thread publishes in order.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._q = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._loop, name="mqtt-tx", daemon=True)
+        self._thread.start()
+
+    def send(self, topic: str, payload, retain: bool = False):
+        self._q.put((topic, payload, retain))
+
+    def send_batch(self, msgs: list):
+        """Queue [(topic, payload, retain), ...] to go out back-to-back."""
+        self._q.put(msgs)
+
+    def _loop(self):
+        # A batch is published without gaps, so paho's network thread (woken by
+        # the first publish) drains the whole tick in one write pass. loop_write()
+        # itself must not be called alongside loop_start().
+        publish = self.client.publish
+        get = self._q.get
+        while True:
+            item = get()
+            if item is None:
+                return
+            for topic, payload, retain in (item if type(item) is list else (item,)):
+                publish(topic, payload, retain=retain)
+
+    def close(self):
+        """Publish everything still queued, then stop the sender thread."""
+        if self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join()
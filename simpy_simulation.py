@@ -1,43 +1,20 @@
 # simpy_simulation.py
-import json
-import os
 from collections import deque, defaultdict
+from itertools import compress
 from typing import List, Dict
 
 import simpy
 import paho.mqtt.client as mqtt
-import pandas as pd
-import joblib
+import numpy as np
 
 from machines import Machine
 from jobs import Job
 from iha_scheduler import run_iha
+from sim_common import (
+    TOPIC_JOB_STATUS, TOPIC_JOBSHOP, TOPIC_TELEMETRY_BATCH,
+    THRESHOLD, MqttSender, dumps, predict_risk,
+)
 
-# ---- Topics (keep same as your current runner) ----
-TOPIC_JOB_STATUS     = "job/status"
-TOPIC_JOBSHOP        = "jobshop/status"
-TOPIC_JOB_TELEMETRY  = "job/telemetry"
-
-# ---- Load ML model + tuned threshold (same logic as your tick runner) ----
-MODEL_PATH = "failure_rf.pkl"
-META_PATH  = "model_meta.json"
-
-model = joblib.load(MODEL_PATH)
-THRESHOLD = 0.5
-if os.path.exists(META_PATH):
-    try:
-        with open(META_PATH, "r") as f:
-            meta = json.load(f)
-        THRESHOLD = float(meta.get("chosen_threshold", meta.get("best_f1_threshold", THRESHOLD)))
-        print(f"[MODEL] Loaded threshold from meta: {THRESHOLD:.3f}")
-    except Exception as e:
-        print(f"[MODEL] Could not read {META_PATH}: {e}. Using default {THRESHOLD:.3f}")
-else:
-    print(f"[MODEL] {META_PATH} not found. Using default threshold {THRESHOLD:.3f}")
-
-# optional conservative bump like your runner
-if THRESHOLD < 0.32:
-    THRESHOLD = 0.32
 
 # ---- SimPy config ----
 ASSIGN_PULSE_MIN     = 1      # how often we try to assign idle machines
@@ -45,53 +22,6 @@ IHA_INTERVAL_MIN     = 10     # reorder cadence
 TELEMETRY_EVERY_MIN  = 1      # publish status/telemetry each simulated minute
 IDLE_GRACE_MIN       = 30     # stop the sim if fully idle for this long
 
-# ---- Local feature builder (mirrors your runner) ----
-_prev = {}
-_roll = defaultdict(lambda: {"temp": deque(maxlen=5), "vib": deque(maxlen=5)})
-
-def build_features(m: Machine, t_seconds: int) -> pd.DataFrame:
-    temp = m.temperature
-    vib = m.vibration
-    t_thresh = m.temp_threshold
-    v_thresh = m.vib_threshold
-    ts_ms = int(t_seconds * 1000)
-
-    dt_s = d_temp = d_vib = None
-    if m.machine_id in _prev:
-        dt_s = (ts_ms - _prev[m.machine_id]["ts_ms"]) / 1000.0
-        d_temp = temp - _prev[m.machine_id]["temp"]
-        d_vib  = vib  - _prev[m.machine_id]["vib"]
-    _prev[m.machine_id] = {"ts_ms": ts_ms, "temp": temp, "vib": vib}
-
-    _roll[m.machine_id]["temp"].append(temp)
-    _roll[m.machine_id]["vib"].append(vib)
-    temp_vals = list(_roll[m.machine_id]["temp"])
-    vib_vals  = list(_roll[m.machine_id]["vib"])
-
-    def _std(arr):
-        n = len(arr)
-        if n < 2: return 0.0
-        m_ = sum(arr)/n
-        return (sum((x-m_)**2 for x in arr)/(n-1))**0.5
-
-    features = {
-        "temperature_c": temp,
-        "vibration_rms_mm_s": vib,
-        "temp_threshold": t_thresh,
-        "vib_threshold": v_thresh,
-        "dt_seconds": dt_s,
-        "d_temp": d_temp,
-        "d_vibration": d_vib,
-        "pct_of_temp_thresh": temp / t_thresh if t_thresh else None,
-        "pct_of_vib_thresh":  vib  / v_thresh if v_thresh  else None,
-        "temp_avg_win": sum(temp_vals)/len(temp_vals),
-        "temp_std_win": _std(temp_vals),
-        "vib_avg_win":  sum(vib_vals)/len(vib_vals),
-        "vib_std_win":  _std(vib_vals),
-        "class_name": m.class_name,
-    }
-    return pd.DataFrame([features])
-
 
 class SimPyWorkspace:
     """
@@ -110,6 +40,9 @@ class SimPyWorkspace:
         self.client.connect(broker, port, keepalive)
         self.client.loop_start()
 
+        # Outbound MQTT: the sim loop only enqueues; one sender thread publishes in order
+        self._tx = MqttSender(self.client)
+
         # Machines (copy of your runner’s defaults)
         self.machines: List[Machine] = [
             Machine("A", "A_1", 40, 100, 2.0, 16.0, 3),
@@ -122,63 +55,112 @@ class SimPyWorkspace:
             Machine("D", "D_1", 35, 120, 1.5, 19.0, 6),
         ]
 
+        # Machines grouped by class, classes in first-seen order (fixed for the
+        # run; a set would iterate in hash-seed order)
+        self._machines_by_class: Dict[str, List[Machine]] = {}
+        for m in self.machines:
+            self._machines_by_class.setdefault(m.class_name, []).append(m)
+        self._classes = tuple(self._machines_by_class)
+
         # Per-class queues like before
         self.class_queues: Dict[str, deque] = defaultdict(deque)
-        for _ in range(seed_jobs):
-            self.enqueue_new_job()
+        for job in Job.make_batch(seed_jobs):
+            self.class_queues[job.required_class].append(job)
 
         self.completed_jobs = set()
 
-        # Spin up background SimPy processes
+        # O(1) idle detection: jobs waiting in any class queue, and machines that
+        # are busy or repairing; both follow every queue / machine transition below
+        self._total_queued = sum(len(q) for q in self.class_queues.values())
+        self._busy_count = 0
+
+        # Telemetry dict per machine, reused every tick (class/id never change)
+        self._tele_tpl: Dict[str, dict] = {
+            m.machine_id: {
+                "timestamp": 0,
+                "class_name": m.class_name,
+                "machine_id": m.machine_id,
+                "temperature_c": m.temperature,
+                "vibration_rms_mm_s": m.vibration,
+                "seq": 0,
+            }
+            for m in self.machines
+        }
+        self._tele_batch: List[dict] = []  # this minute's telemetry, one entry per machine
+        self._tick_out: List[tuple] = []    # this minute's retained statuses, sent with it
+        # Static thresholds as arrays parallel to self.machines; a zero threshold
+        # becomes inf so that reading never counts as near its limit
+        self._temp_thr = np.array([m.temp_threshold or np.inf for m in self.machines], dtype=np.float64)
+        self._vib_thr = np.array([m.vib_threshold or np.inf for m in self.machines], dtype=np.float64)
+        # class -> (inputs of the last IHA solve, its assignments)
+        self._iha_cache: Dict[str, tuple] = {}
+        # machine_id -> status key of the last retained status published
+        self._status_sent: Dict[str, tuple] = {}
+        self._risk: Dict[str, float] = {}  # machine_id -> this minute's failure risk
+
+        # Spin up background SimPy processes (one tick loop drives every machine)
         self.env.process(self._assigner_loop())
         self.env.process(self._iha_pulse())
         self.env.process(self._idle_shutdown_monitor(IDLE_GRACE_MIN))
-        for m in self.machines:
-            self.env.process(self._machine_driver(m))
+        self.env.process(self._tick_loop())
 
     # ---------- MQTT ----------
     def _on_connect(self, client, userdata, flags, rc):
         print("[MQTT] Connected" if rc == 0 else f"[MQTT] Failed rc={rc}")
 
+    def close(self):
+        """Flush queued publishes and disconnect from the broker."""
+        self._tx.close()
+        self.client.loop_stop()
+        self.client.disconnect()
+
     def _publish_jobshop_event(self, event_type: str, payload: dict):
-        self.client.publish(TOPIC_JOBSHOP, json.dumps({"type": event_type, **payload}))
+        self._tx.send(TOPIC_JOBSHOP, dumps({"type": event_type, **payload}))
 
     def _publish_job_status(self, machine: Machine, t_sec: int):
+        """Queue machine's retained status for this minute's snapshot batch, unless unchanged."""
         doc_json = machine.status_json(t_sec)
-        self.client.publish(TOPIC_JOB_STATUS, doc_json, retain=True)
+        key = machine._status_key
+        if self._status_sent.get(machine.machine_id) != key:
+            self._status_sent[machine.machine_id] = key
+            self._tick_out.append((TOPIC_JOB_STATUS, doc_json, True))
 
     def _publish_job_telemetry(self, machine: Machine, t_sec: int):
-        msg = {
-            "timestamp": t_sec,
-            "class_name": machine.class_name,
-            "machine_id": machine.machine_id,
-            "temperature_c": getattr(machine, "temperature", machine.temp_base),
-            "vibration_rms_mm_s": getattr(machine, "vibration", machine.vib_base),
-            "seq": t_sec,
-        }
-        self.client.publish(TOPIC_JOB_TELEMETRY, json.dumps(msg))
+        """Add machine's reading to this minute's telemetry batch."""
+        msg = self._tele_tpl[machine.machine_id]
+        msg["timestamp"] = t_sec
+        msg["temperature_c"] = machine.temperature
+        msg["vibration_rms_mm_s"] = machine.vibration
+        msg["seq"] = t_sec
+        self._tele_batch.append(msg)
         return msg
 
+    def _flush_tick(self, t_sec: int):
+        """Send this minute's statuses plus one aggregated telemetry message as one batch."""
+        out = self._tick_out
+        out.append((TOPIC_TELEMETRY_BATCH, dumps({"t": t_sec, "items": self._tele_batch}), False))
+        self._tx.send_batch(out)
+        self._tele_batch = []
+        self._tick_out = []
+
     # ---------- Queue helpers ----------
     def enqueue_new_job(self):
         job = Job.make_random()
         self.class_queues[job.required_class].append(job)
+        self._total_queued += 1
 
     def _enqueue_current_step_front(self, job: Job):
         self.class_queues[job.required_class].appendleft(job)
+        self._total_queued += 1
 
     def _enqueue_next_step(self, job: Job):
         if not job.done:
             self.class_queues[job.required_class].append(job)
+            self._total_queued += 1
 
     # ---------- Completion / idle detection ----------
     def _all_done(self) -> bool:
-        queues_empty = all(len(q) == 0 for q in self.class_queues.values())
-        machines_idle = all(
-            (m.busy_with is None) and (getattr(m, "repairing_left", 0) <= 0)
-            for m in self.machines
-        )
-        return queues_empty and machines_idle
+        return self._total_queued == 0 and self._busy_count == 0
 
     def _idle_shutdown_monitor(self, idle_grace_min=30):
         """Stop the sim if everything is idle for 'idle_grace_min' simulated minutes."""
@@ -200,13 +182,15 @@ class SimPyWorkspace:
         """Assign idle machines every ASSIGN_PULSE_MIN simulated minutes."""
         while True:
             for m in self.machines:
-                if getattr(m, "repairing_left", 0) > 0 or not m.idle:
+                if m.repairing_left > 0 or not m.idle:
                     continue
                 cls = m.class_name
                 if not self.class_queues[cls]:
                     continue
                 job = self.class_queues[cls].popleft()
                 if m.assign(job):
+                    self._total_queued -= 1
+                    self._busy_count += 1
                     t = int(self.env.now)
                     self._publish_jobshop_event("STARTED", {
                         "timestamp": t,
@@ -222,6 +206,19 @@ class SimPyWorkspace:
                     print(f"[ASSIGN] {m.machine_id} unable to take {job.job_id}, requeued.")
             yield self.env.timeout(ASSIGN_PULSE_MIN)
 
+    def _solve_iha(self, cls: str, ready_jobs: List[Job], class_machines: List[Machine]):
+        """run_iha, reusing the last result for cls when nothing it reads has changed."""
+        key = (
+            tuple([(j.job_id, j.remaining_ticks_on_step) for j in ready_jobs]),
+            tuple([(m.temperature, m.vibration) for m in class_machines]),
+        )
+        hit = self._iha_cache.get(cls)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+        assignments = run_iha(ready_jobs, class_machines, weights=(0.6, 0.4))
+        self._iha_cache[cls] = (key, assignments)
+        return assignments
+
     def _iha_pulse(self):
         """Reorder class queues periodically using your IHA scheduler."""
         while True:
@@ -232,44 +229,63 @@ class SimPyWorkspace:
                 continue
 
             any_change = False
-            for cls in list(self.class_queues.keys()):
+            for cls in self._classes:
                 ready_jobs = list(self.class_queues[cls])
-                class_machines = [m for m in self.machines if m.class_name == cls]
+                class_machines = self._machines_by_class[cls]
                 if not ready_jobs or not class_machines:
                     continue
 
-                assignments = run_iha(ready_jobs, class_machines, weights=(0.6, 0.4))
+                assignments = self._solve_iha(cls, ready_jobs, class_machines)
                 if not assignments:
                     continue
 
                 ordered_jobs = [j for j, _ in assignments]
-                remaining    = [j for j in ready_jobs if j not in ordered_jobs]
-                new_queue    = deque(ordered_jobs + remaining)
+                ordered_ids  = {id(j) for j in ordered_jobs}  # Job is an unhashable dataclass
+                remaining    = [j for j in ready_jobs if id(j) not in ordered_ids]
+                new_order    = ordered_jobs + remaining
 
-                if list(new_queue) != list(self.class_queues[cls]):
-                    self.class_queues[cls] = new_queue
+                # Same jobs either way, so a positional identity scan detects any reorder
+                if any(a is not b for a, b in zip(new_order, self.class_queues[cls])):
+                    self.class_queues[cls] = deque(new_order)
                     any_change = True
 
             if any_change:
                 print(f"[IHA] Reordered at t={int(self.env.now)}")
 
     # ---------- Machine driver ----------
+    def _near_limit_mask(self) -> np.ndarray:
+        """Per machine (self.machines order): temperature or vibration at >= 80% of its threshold."""
+        machines = self.machines
+        n = len(machines)
+        temp = np.fromiter((m.temperature for m in machines), dtype=np.float64, count=n)
+        vib = np.fromiter((m.vibration for m in machines), dtype=np.float64, count=n)
+        return (temp / self._temp_thr >= 0.80) | (vib / self._vib_thr >= 0.80)
+
+    def _update_risks(self):
+        """
+        Advance features for all busy machines this minute, but score only those
+        near a limit (the only ones that can be preempted), in one call.
+        """
+        machines = self.machines
+        idx = [i for i, m in enumerate(machines)
+               if m.repairing_left <= 0 and m.busy_with is not None]
+        self._risk = {}
+        if idx:
+            near = self._near_limit_mask()[idx]
+            try:
+                probs = predict_risk([machines[i] for i in idx], int(self.env.now), near)
+                self._risk = {machines[i].machine_id: float(p)
+                              for i, p in zip(compress(idx, near), probs)}
+            except Exception as e:
+                print(f"[INFER] Predict failed for {len(idx)} machines: {e}")
+
     def _maybe_predict_and_preempt(self, m: Machine):
-        """Call your RF model; if risky & near-limit, preempt like original code."""
-        if getattr(m, "repairing_left", 0) > 0 or m.busy_with is None:
-            return
-        X = build_features(m, int(self.env.now))
-        try:
-            prob = float(model.predict_proba(X)[0, 1])
-        except Exception as e:
-            print(f"[INFER] Predict failed for {m.machine_id}: {e}")
+        """Use the cached RF risk of a near-limit machine; if risky, preempt like original code."""
+        prob = self._risk.get(m.machine_id)
+        if prob is None:
             return
 
-        near_limit = (
-            (m.temp_threshold and (m.temperature / m.temp_threshold) >= 0.80) or
-            (m.vib_threshold  and (m.vibration  / m.vib_threshold)  >= 0.80)
-        )
-        if prob >= THRESHOLD and near_limit:
+        if prob >= THRESHOLD:
             j = m.busy_with
             self._publish_jobshop_event("PREDICTION", {
                 "timestamp": int(self.env.now),
@@ -279,86 +295,106 @@ class SimPyWorkspace:
                 "risk_score": prob,
                 "threshold": THRESHOLD,
             })
-            if j:
-                j.put_back_unfinished_step_front()
+            if m.preempt() is not None:
                 self._enqueue_current_step_front(j)
-                m.busy_with = None
-            m.repairing_left = m.repair_time
+                if m.repairing_left <= 0:
+                    self._busy_count -= 1  # no repair time: idle straight away
 
-    def _machine_driver(self, m: Machine):
+    def _tick_loop(self):
         """
-        One SimPy process per machine.
+        Single SimPy process driving every machine.
         Each simulated minute:
+          - score busy machines in one batch
+          - drive each machine in self.machines order
+          - send the minute's status + telemetry snapshot
+        """
+        while True:
+            self._update_risks()
+            for m in self.machines:
+                self._drive_machine(m)
+            self._flush_tick(int(self.env.now))
+            yield self.env.timeout(TELEMETRY_EVERY_MIN)
+
+    def _drive_machine(self, m: Machine):
+        """
+        One simulated minute of one machine:
           - run predictive check
           - call m.step() once (reuses your physics/thresholds)
           - publish status + telemetry (so infer.py keeps working)
         """
-        while True:
-            # 1) predictive preemption (RF model)
-            self._maybe_predict_and_preempt(m)
-
-            # 2) perform one "tick" of machine work using existing step()
-            event, data = m.step()   # returns FAILED / STEP_DONE / COMPLETED / None
-
-            # 3) publish status + telemetry every minute
-            t = int(self.env.now)
-            self._publish_job_status(m, t)
-            self._publish_job_telemetry(m, t)
-
-            # 4) handle events like your old tick loop
-            if event == "FAILED":
-                j = data
-                if j:
-                    self._enqueue_current_step_front(j)
-                    self._publish_jobshop_event("FAILED", {
-                        "timestamp": t,
-                        "machine_id": m.machine_id,
-                        "class": m.class_name,
-                        "job_id": j.job_id,
-                        "reason": "threshold_exceeded",
-                        "temperature": round(m.temperature, 2),
-                        "vibration": round(m.vibration, 2),
-                    })
-                print(f"[EVENT] {m.machine_id} FAILED — reordering class {m.class_name}")
-                # reorder only this class
-                ready_jobs = list(self.class_queues[m.class_name])
-                class_machines = [mm for mm in self.machines if mm.class_name == m.class_name]
-                if ready_jobs and class_machines:
-                    assignments = run_iha(ready_jobs, class_machines, weights=(0.6, 0.4))
-                    if assignments:
-                        ordered = [jj for jj, _ in assignments]
-                        remaining = [jj for jj in ready_jobs if jj not in ordered]
-                        self.class_queues[m.class_name] = deque(ordered + remaining)
-
-            elif event == "STEP_DONE":
-                j = data
-                self._publish_jobshop_event("STEP_DONE", {
-                    "timestamp": t,
-                    "job_id": j.job_id,
-                    "next_required_class": ("" if j.done else j.required_class),
-                })
-                self._enqueue_next_step(j)
-                print(f"[EVENT] {j.job_id} STEP_DONE → next {j.required_class}")
-
-            elif event == "COMPLETED":
-                j = data
-                self.completed_jobs.add(j.job_id)
-                self._publish_jobshop_event("COMPLETED", {
+        # 1) predictive preemption (RF model); busy -> repairing keeps the busy count
+        self._maybe_predict_and_preempt(m)
+
+        # 2) perform one "tick" of machine work using existing step()
+        repairing = m.repairing_left > 0
+        event, data = m.step()   # returns FAILED / STEP_DONE / COMPLETED / None
+        if repairing and m.repairing_left <= 0:
+            self._busy_count -= 1  # repair finished: machine is idle again
+
+        # 3) publish status + telemetry every minute
+        t = int(self.env.now)
+        self._publish_job_status(m, t)
+        self._publish_job_telemetry(m, t)
+
+        # 4) handle events like your old tick loop
+        if event == "FAILED":
+            j = data
+            if m.repairing_left <= 0:
+                self._busy_count -= 1  # no repair time: idle straight away
+            if j:
+                self._enqueue_current_step_front(j)
+                self._publish_jobshop_event("FAILED", {
                     "timestamp": t,
-                    "job_id": j.job_id,
                     "machine_id": m.machine_id,
+                    "class": m.class_name,
+                    "job_id": j.job_id,
+                    "reason": "threshold_exceeded",
+                    "temperature": round(m.temperature, 2),
+                    "vibration": round(m.vibration, 2),
                 })
-                print(f"[EVENT] {j.job_id} COMPLETED on {m.machine_id}")
-
-            # 5) advance simulated time by one minute
-            yield self.env.timeout(TELEMETRY_EVERY_MIN)
+            print(f"[EVENT] {m.machine_id} FAILED — reordering class {m.class_name}")
+            # reorder only this class
+            ready_jobs = list(self.class_queues[m.class_name])
+            class_machines = self._machines_by_class[m.class_name]
+            if ready_jobs and class_machines:
+                assignments = self._solve_iha(m.class_name, ready_jobs, class_machines)
+                if assignments:
+                    ordered = [jj for jj, _ in assignments]
+                    ordered_ids = {id(jj) for jj in ordered}
+                    remaining = [jj for jj in ready_jobs if id(jj) not in ordered_ids]
+                    self.class_queues[m.class_name] = deque(ordered + remaining)
+
+        elif event == "STEP_DONE":
+            j = data
+            self._busy_count -= 1
+            self._publish_jobshop_event("STEP_DONE", {
+                "timestamp": t,
+                "job_id": j.job_id,
+                "next_required_class": ("" if j.done else j.required_class),
+            })
+            self._enqueue_next_step(j)
+            print(f"[EVENT] {j.job_id} STEP_DONE → next {j.required_class}")
+
+        elif event == "COMPLETED":
+            j = data
+            self._busy_count -= 1
+            self.completed_jobs.add(j.job_id)
+            self._publish_jobshop_event("COMPLETED", {
+                "timestamp": t,
+                "job_id": j.job_id,
+                "machine_id": m.machine_id,
+            })
+            print(f"[EVENT] {j.job_id} COMPLETED on {m.machine_id}")
 
 
 def main():
     env = simpy.Environment()
-    SimPyWorkspace(env, seed_jobs=5)
-    # run until idle monitor calls env.exit()
-    env.run()
+    ws = SimPyWorkspace(env, seed_jobs=5)
+    try:
+        # run until idle monitor calls env.exit()
+        env.run()
+    finally:
+        ws.close()
 
 
 if __name__ == "__main__":
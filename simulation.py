@@ -1,93 +1,24 @@
 import time
 import random
-import json
 from collections import deque, defaultdict
+from itertools import compress
 from typing import List, Dict
-import os
 import paho.mqtt.client as mqtt
-import pandas as pd
-import joblib
+import numpy as np
 
 from machines import Machine
 from jobs import Job
 
 from iha_scheduler import run_iha
+from sim_common import (
+    TOPIC_JOB_STATUS, TOPIC_JOBSHOP, TOPIC_TELEMETRY_BATCH,
+    THRESHOLD, MqttSender, dumps, predict_risk,
+)
 
 
-TOPIC_JOB_STATUS     = "job/status"
-TOPIC_JOBSHOP        = "jobshop/status"
-TOPIC_JOB_TELEMETRY  = "job/telemetry"
-
-# --- Load ML model + threshold ---
-MODEL_PATH = "failure_rf.pkl"
-META_PATH  = "model_meta.json"
-
-model = joblib.load(MODEL_PATH)
-THRESHOLD = 0.5
-if os.path.exists(META_PATH):
-    try:
-        with open(META_PATH, "r") as f:
-            meta = json.load(f)
-        THRESHOLD = float(meta.get("chosen_threshold", meta.get("best_f1_threshold", THRESHOLD)))
-        print(f"[MODEL] Loaded threshold from meta: {THRESHOLD:.3f}")
-    except Exception as e:
-        print(f"[MODEL] Could not read {META_PATH}: {e}. Using default {THRESHOLD:.3f}")
-else:
-    print(f"[MODEL] {META_PATH} not found. Using default threshold {THRESHOLD:.3f}")
-
-# optional conservative bump to reduce early preemptions on cold start
-if THRESHOLD < 0.32:
-    THRESHOLD = 0.32
-
 # --- Warmup control (minimal change to reduce initial burst of failures) ---
 WARMUP_TICKS = 3  # assign at most one job per class per tick during first few ticks
 IHA_INTERVAL = 10
-# --- Feature builder state ---
-_prev = {}
-_roll = defaultdict(lambda: {"temp": deque(maxlen=5), "vib": deque(maxlen=5)})
-
-def build_features(m: Machine, t: int) -> pd.DataFrame:
-    temp = m.temperature
-    vib = m.vibration
-    t_thresh = m.temp_threshold
-    v_thresh = m.vib_threshold
-    ts_ms = int(t * 1000)
-
-    dt_s = d_temp = d_vib = None
-    if m.machine_id in _prev:
-        dt_s = (ts_ms - _prev[m.machine_id]["ts_ms"]) / 1000.0
-        d_temp = temp - _prev[m.machine_id]["temp"]
-        d_vib = vib - _prev[m.machine_id]["vib"]
-    _prev[m.machine_id] = {"ts_ms": ts_ms, "temp": temp, "vib": vib}
-
-    _roll[m.machine_id]["temp"].append(temp)
-    _roll[m.machine_id]["vib"].append(vib)
-    temp_vals = list(_roll[m.machine_id]["temp"])
-    vib_vals = list(_roll[m.machine_id]["vib"])
-
-    def _std(arr):
-        n = len(arr)
-        if n < 2: return 0.0
-        m_ = sum(arr)/n
-        return (sum((x-m_)**2 for x in arr)/(n-1))**0.5
-
-    features = {
-        "temperature_c": temp,
-        "vibration_rms_mm_s": vib,
-        "temp_threshold": t_thresh,
-        "vib_threshold": v_thresh,
-        "dt_seconds": dt_s,
-        "d_temp": d_temp,
-        "d_vibration": d_vib,
-        "pct_of_temp_thresh": temp / t_thresh if t_thresh else None,
-        "pct_of_vib_thresh":  vib / v_thresh if v_thresh else None,
-        "temp_avg_win": sum(temp_vals)/len(temp_vals),
-        "temp_std_win": _std(temp_vals),
-        "vib_avg_win":  sum(vib_vals)/len(vib_vals),
-        "vib_std_win":  _std(vib_vals),
-        "class_name": m.class_name,
-    }
-    return pd.DataFrame([features])
 
 
 class WorkspaceSimulation:
@@ -106,6 +37,9 @@ class WorkspaceSimulation:
         self.client.connect(broker, port, keepalive)
         self.client.loop_start()
 
+        # Outbound MQTT: the sim loop only enqueues; one sender thread publishes in order
+        self._tx = MqttSender(self.client)
+
         self.t = 0
         self.tick_seconds = tick_seconds
 
@@ -120,11 +54,39 @@ class WorkspaceSimulation:
             Machine("D", "D_1", 35, 120, 1.5, 19.0, 6),
         ]
 
+        # Machines grouped by class, classes in first-seen order (fixed for the
+        # run; a set would iterate in hash-seed order)
+        self._machines_by_class: Dict[str, List[Machine]] = {}
+        for m in self.machines:
+            self._machines_by_class.setdefault(m.class_name, []).append(m)
+        self._classes = tuple(self._machines_by_class)
+
         self.class_queues: Dict[str, deque] = defaultdict(deque)
-        for _ in range(seed_jobs):
-            self.enqueue_new_job()
+        for job in Job.make_batch(seed_jobs):
+            self.class_queues[job.required_class].append(job)
 
         self.completed_jobs = set()
+
+        # Telemetry dict per machine, reused every tick (class/id never change)
+        self._tele_tpl: Dict[str, dict] = {
+            m.machine_id: {
+                "timestamp": 0,
+                "class_name": m.class_name,
+                "machine_id": m.machine_id,
+                "temperature_c": m.temperature,
+                "vibration_rms_mm_s": m.vibration,
+                "seq": 0,
+            }
+            for m in self.machines
+        }
+        # Static thresholds as arrays parallel to self.machines; a zero threshold
+        # becomes inf so that reading never counts as near its limit
+        self._temp_thr = np.array([m.temp_threshold or np.inf for m in self.machines], dtype=np.float64)
+        self._vib_thr = np.array([m.vib_threshold or np.inf for m in self.machines], dtype=np.float64)
+        # class -> (inputs of the last IHA solve, its assignments)
+        self._iha_cache: Dict[str, tuple] = {}
+        # machine_id -> status key of the last retained status published
+        self._status_sent: Dict[str, tuple] = {}
         # self.initial_allocation()
     
     def initial_allocation(self):
@@ -152,23 +114,34 @@ class WorkspaceSimulation:
 
     def _publish_jobshop_event(self, event_type: str, payload: dict):
         msg = {"type": event_type, **payload}
-        self.client.publish(TOPIC_JOBSHOP, json.dumps(msg))
+        self._tx.send(TOPIC_JOBSHOP, dumps(msg))
+
+    def _telemetry_msg(self, machine: Machine) -> dict:
+        msg = self._tele_tpl[machine.machine_id]
+        msg["timestamp"] = self.t
+        msg["temperature_c"] = machine.temperature
+        msg["vibration_rms_mm_s"] = machine.vibration
+        msg["seq"] = self.t
+        return msg
 
-    def _publish_job_status(self, machine: Machine):
+    def _publish_tick_snapshot(self):
+        """
+        Publish status for every machine plus one aggregated telemetry message per tick.
+        Payloads are encoded to bytes here and handed to the sender thread as one batch.
+        A machine's status is skipped while its rounded snapshot is unchanged; the
+        retained copy on the broker already carries it.
+        """
         # RETAIN latest snapshot so late-joining UI immediately sees all machines
-        self.client.publish(TOPIC_JOB_STATUS, machine.status_json(self.t), retain=True)
-
-    def _publish_job_telemetry(self, machine: Machine):
-        msg = {
-            "timestamp": self.t,
-            "class_name": machine.class_name,
-            "machine_id": machine.machine_id,
-            "temperature_c": getattr(machine, "temperature", machine.temp_base),
-            "vibration_rms_mm_s": getattr(machine, "vibration", machine.vib_base),
-            "seq": self.t,
-        }
-        self.client.publish(TOPIC_JOB_TELEMETRY, json.dumps(msg))
-        return msg
+        sent = self._status_sent
+        msgs = []
+        for m in self.machines:
+            doc_json = m.status_json(self.t)
+            if sent.get(m.machine_id) != m._status_key:
+                sent[m.machine_id] = m._status_key
+                msgs.append((TOPIC_JOB_STATUS, doc_json.encode(), True))
+        items = [self._telemetry_msg(m) for m in self.machines]
+        msgs.append((TOPIC_TELEMETRY_BATCH, dumps({"t": self.t, "items": items}), False))
+        self._tx.send_batch(msgs)
 
     # --- Queue helpers ---
     def enqueue_new_job(self):
@@ -190,7 +163,7 @@ class WorkspaceSimulation:
         """
         for m in self.machines:
             # Skip if machine is repairing or busy
-            if getattr(m, "repairing_left", 0) > 0 or not m.idle:
+            if m.repairing_left > 0 or not m.idle:
                 continue
 
             cls = m.class_name
@@ -216,23 +189,38 @@ class WorkspaceSimulation:
                 print(f"[ASSIGN] {m.machine_id} unable to take {job.job_id}, requeued.")
 
     # --- Prediction ---
-    def _maybe_predict_failure(self, m: Machine):
-        if getattr(m, "repairing_left", 0) > 0 or m.busy_with is None:
-            return
-
-        X = build_features(m, self.t)
+    def _near_limit_mask(self) -> np.ndarray:
+        """Per machine (self.machines order): temperature or vibration at >= 80% of its threshold."""
+        machines = self.machines
+        n = len(machines)
+        temp = np.fromiter((m.temperature for m in machines), dtype=np.float64, count=n)
+        vib = np.fromiter((m.vibration for m in machines), dtype=np.float64, count=n)
+        return (temp / self._temp_thr >= 0.80) | (vib / self._vib_thr >= 0.80)
+
+    def _predict_failure_risks(self) -> Dict[str, float]:
+        """
+        Features advance for every busy, non-repairing machine, but only those near
+        a limit (the only ones that can be preempted) are scored, in one call.
+        """
+        machines = self.machines
+        idx = [i for i, m in enumerate(machines)
+               if m.repairing_left <= 0 and m.busy_with is not None]
+        if not idx:
+            return {}
+        near = self._near_limit_mask()[idx]
         try:
-            prob = float(model.predict_proba(X)[0, 1])
+            probs = predict_risk([machines[i] for i in idx], self.t, near)
         except Exception as e:
-            print(f"[INFER] Predict failed for {m.machine_id}: {e}")
-            return
+            print(f"[INFER] Predict failed for {len(idx)} machines: {e}")
+            return {}
+        return {machines[i].machine_id: float(p) for i, p in zip(compress(idx, near), probs)}
 
-        near_limit = (
-            (m.temp_threshold and (m.temperature / m.temp_threshold) >= 0.80) or
-            (m.vib_threshold and (m.vibration / m.vib_threshold) >= 0.80)
-        )
+    def _maybe_predict_failure(self, m: Machine, prob):
+        """Act on this tick's risk score for a near-limit m (None when it has none)."""
+        if prob is None:
+            return
 
-        if prob >= THRESHOLD and near_limit:
+        if prob >= THRESHOLD:
             j = m.busy_with
             self._publish_jobshop_event("PREDICTION", {
                 "timestamp": self.t,
@@ -242,13 +230,23 @@ class WorkspaceSimulation:
                 "risk_score": prob,
                 "threshold": THRESHOLD,
             })
-            if j:
-                j.put_back_unfinished_step_front()
+            if m.preempt() is not None:
                 self._enqueue_current_step_front(j)
-                m.busy_with = None
-            m.repairing_left = m.repair_time
             
     #-----------------------------------IHA----------------------------------------------
+
+    def _solve_iha(self, cls: str, ready_jobs: List[Job], class_machines: List[Machine]):
+        """run_iha, reusing the last result for cls when nothing it reads has changed."""
+        key = (
+            tuple([(j.job_id, j.remaining_ticks_on_step) for j in ready_jobs]),
+            tuple([(m.temperature, m.vibration) for m in class_machines]),
+        )
+        hit = self._iha_cache.get(cls)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+        assignments = run_iha(ready_jobs, class_machines, weights=(0.6, 0.4))
+        self._iha_cache[cls] = (key, assignments)
+        return assignments
     
     def _run_iha_scheduler(self, target_class=None):
         """
@@ -261,7 +259,7 @@ class WorkspaceSimulation:
         """
         print(f"\n[IHA] Scheduler called at tick={self.t}, target_class={target_class or 'ALL'}")
 
-        unique_classes = list(self.class_queues.keys())
+        unique_classes = self._classes
         if not unique_classes:
             print("[IHA] No class queues found — skipping scheduler.")
             return
@@ -270,11 +268,11 @@ class WorkspaceSimulation:
             if target_class not in unique_classes:
                 print(f"[IHA] Target class '{target_class}' not found — skipping.")
                 return
-            unique_classes = [target_class]
+            unique_classes = (target_class,)
 
         for cls in unique_classes:
             # ✅ Include both idle and busy machines
-            class_machines = [m for m in self.machines if m.class_name == cls]
+            class_machines = self._machines_by_class[cls]
 
             # All waiting jobs (including queued ones)
             ready_jobs = list(self.class_queues[cls])
@@ -291,7 +289,7 @@ class WorkspaceSimulation:
                 f"with {len(ready_jobs)} jobs and {len(class_machines)} machines.")
 
             # Run IHA using all machines (predictive mode)
-            assignments = run_iha(ready_jobs, class_machines, weights=(0.6, 0.4))
+            assignments = self._solve_iha(cls, ready_jobs, class_machines)
 
             if not assignments:
                 print(f"[IHA] No valid assignments found for class {cls}, keeping original queue.")
@@ -299,7 +297,8 @@ class WorkspaceSimulation:
 
             # New queue ordering
             ordered_jobs = [job for job, _ in assignments]
-            remaining_jobs = [j for j in ready_jobs if j not in ordered_jobs]
+            ordered_ids = {id(j) for j in ordered_jobs}  # Job is an unhashable dataclass
+            remaining_jobs = [j for j in ready_jobs if id(j) not in ordered_ids]
             final_order = ordered_jobs + remaining_jobs
 
             self.class_queues[cls] = deque(final_order)
@@ -317,14 +316,10 @@ class WorkspaceSimulation:
 
         for m in self.machines:
             # Detect when a machine just finished repair (optional until RECOVERY event is added)
-            if hasattr(m, "was_repairing"):
-                repairing_left = getattr(m, "repairing_left", 0.0)
-                currently_repairing = repairing_left > 0.0001
-                if m.was_repairing and not currently_repairing:
-                    recoveries.append(m)
-                m.was_repairing = currently_repairing
-            else:
-                m.was_repairing = getattr(m, "repairing_left", 0.0) > 0.0001
+            currently_repairing = m.repairing_left > 0
+            if m.was_repairing and not currently_repairing:
+                recoveries.append(m)
+            m.was_repairing = currently_repairing
 
         # Trigger IHA only for recoveries or periodically
         if self.t % IHA_INTERVAL == 1:
@@ -338,11 +333,14 @@ class WorkspaceSimulation:
         
 
         # --- Machine processing loop ---
+        # A machine's risk depends only on its own state, so all of them are
+        # scored up front; preemption itself still happens in machine order.
+        risks = self._predict_failure_risks()
+        # Classes whose queue changed this tick; IHA reorders each once after the loop
+        dirty = {}
         for m in self.machines:
-            self._maybe_predict_failure(m)
+            self._maybe_predict_failure(m, risks.get(m.machine_id))
             event, data = m.step()
-            self._publish_job_status(m)
-            self._publish_job_telemetry(m)
 
             # --- Handle machine events ---
             if event == "FAILED":
@@ -359,7 +357,7 @@ class WorkspaceSimulation:
                         "vibration": round(m.vibration, 2),
                     })
                 print(f"[EVENT] Machine {m.machine_id} FAILED — reordering queue for class {m.class_name}")
-                self._run_iha_scheduler(m.class_name)  # reorder all queues so load is adjusted
+                dirty[m.class_name] = True
 
             elif event == "STEP_DONE":
                 j = data
@@ -372,7 +370,7 @@ class WorkspaceSimulation:
                 self._enqueue_next_step(j)
                 print(f"[EVENT] Job {j.job_id} STEP_DONE — updating next queue ({j.required_class})")
                 # Reorder only the next required class queue
-                self._run_iha_scheduler(j.required_class)
+                dirty[j.required_class] = True
 
             elif event == "COMPLETED":
                 j = data
@@ -385,23 +383,42 @@ class WorkspaceSimulation:
                 
                 print(f"[EVENT] Job {j.job_id} COMPLETED on {m.machine_id}")
 
+        # --- One IHA reorder per affected class (in first-event order) ---
+        for cls in dirty:
+            self._run_iha_scheduler(cls)
+
+        # --- Status/telemetry snapshot (state after every machine stepped) ---
+        self._publish_tick_snapshot()
+
         # --- End of tick checks ---
         all_idle = all(m.idle for m in self.machines)
         queues_empty = all(len(q) == 0 for q in self.class_queues.values())
         if all_idle and queues_empty:
             print(f"[SIM] All jobs completed at t={self.t}. Disconnecting…")
+            self._tx.close()
             self.client.loop_stop()
             self.client.disconnect()
             raise SystemExit
 
     def run(self, max_ticks=120):
+        # Pace ticks against a monotonic deadline so time spent inside tick()
+        # (stepping, publishing, IHA) does not accumulate as drift.
+        deadline = time.monotonic()
         try:
             for _ in range(max_ticks):
                 self.tick()
-                time.sleep(self.tick_seconds)
+                deadline += self.tick_seconds
+                sleep_for = deadline - time.monotonic()
+                if sleep_for > 0:
+                    time.sleep(sleep_for)
+                elif sleep_for < -self.tick_seconds:
+                    # Overran by more than a full tick: don't try to catch up
+                    print(f"[SIM] Tick {self.t} overran by {-sleep_for:.2f}s")
+                    deadline = time.monotonic()
         except SystemExit:
             pass
         finally:
+            self._tx.close()
             self.client.loop_stop()
             self.client.disconnect()
             print("[MQTT] Disconnected")
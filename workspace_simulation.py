@@ -1,10 +1,41 @@
+import argparse
 import time
 import random
 import json
+import socket
+import sys
+from collections import defaultdict, deque
+import numpy as np
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
 from machines import Machine
-from codes.jobs import Job
+from jobs import Job
+
+
+def _dumps(obj) -> bytes:
+    """Compact JSON bytes for publish() (orjson when installed)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Machines as (class_name, machine_id, temp_base, temp_threshold, vib_base,
+# vib_threshold, repair_time), in Machine's field order
+MACHINE_CONFIGS = (
+    ("A", "A_1", 40, 95, 2, 12, 3),
+    ("A", "A_2", 42, 97, 2.5, 13, 3),
+    ("B", "B_1", 50, 100, 4, 16, 5),
+    ("C", "C_1", 30, 90, 3, 14, 4),
+    ("D", "D_1", 35, 85, 1.5, 10, 2),
+)
+
+N_JOBS = 10
+
 
 class WorkspaceSimulation:
     """
@@ -12,33 +43,67 @@ class WorkspaceSimulation:
     Monitors sensor readings and sends abnormalreadings to MQTT broker.
     """
     
-    def __init__(self):
+    OFFLINE_BUFFER = 1000  # timestep batches kept while the broker is unreachable
+    
+    def __init__(self, verbose=False):
+        # Per-machine console lines (readings, alerts, processing) are off the
+        # per-timestep path unless verbose
+        self.verbose = verbose
+        
         # MQTT Configuration
         self.MQTT_BROKER_ADDRESS = "localhost"
         self.MQTT_PORT = 1883
         self.MQTT_KEEPALIVE = 60
         self.MQTT_TOPIC_PREFIX = "shopfloor/machine"
         self.MQTT_ALERT_TOPIC = "shopfloor/alerts"
+        self.MQTT_BATCH_TOPIC = "shopfloor/batch"  # one message per timestep: readings + alerts
         
-        # Initialize MQTT client
+        # Initialize MQTT client; while it is offline, timestep batches wait in a
+        # bounded local buffer (oldest dropped) instead of paho's unbounded queue
+        self._connected = False
+        self._offline = deque(maxlen=self.OFFLINE_BUFFER)
         self.mqtt_client = mqtt.Client()
         self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.connect(self.MQTT_BROKER_ADDRESS, self.MQTT_PORT, self.MQTT_KEEPALIVE)
         self.mqtt_client.loop_start()
         
         # Initialize machines and jobs
         self.machines = self.create_machines()
+        self._machines_by_id = {m.machine_id: m for m in self.machines}
+        self._build_alert_templates()
+        # Static per-machine values as arrays parallel to self.machines
+        self._temp_base = np.array([m.temp_base for m in self.machines], dtype=np.float64)
+        self._vib_base = np.array([m.vib_base for m in self.machines], dtype=np.float64)
+        self._temp_thr = np.array([m.temp_threshold for m in self.machines], dtype=np.float64)
+        self._vib_thr = np.array([m.vib_threshold for m in self.machines], dtype=np.float64)
+        # Private generators, seeded from `random` so random.seed() still reproduces a run
+        self._rng = random.Random(random.getrandbits(64))
+        self._rng_np = np.random.default_rng(random.getrandbits(64))
         self.jobs = self.create_jobs()
         self.current_jobs = {}  # Track which machine is processing which job
         self.completed_jobs = []
         self.timestep = 0
+        self._tick_readings = []  # this timestep's status JSON strings
+        self._tick_alerts = []    # this timestep's alert dicts
         
         # Random event tracking
         self.random_events = {
-            'machine_failure': {'timestep': random.randint(8, 15), 'machine': random.choice(['A_1', 'B_1', 'C_1'])},
-            'temperature_spike': {'timestep': random.randint(6, 12), 'machine': random.choice(['A_1', 'A_2', 'B_1'])},
-            'high_load': {'timestep': random.randint(4, 10), 'machine': random.choice(['C_1', 'D_1'])}
+            'machine_failure': {'timestep': self._rng.randint(8, 15), 'machine': self._rng.choice(['A_1', 'B_1', 'C_1'])},
+            'temperature_spike': {'timestep': self._rng.randint(6, 12), 'machine': self._rng.choice(['A_1', 'A_2', 'B_1'])},
+            'high_load': {'timestep': self._rng.randint(4, 10), 'machine': self._rng.choice(['C_1', 'D_1'])}
+        }
+        # Same schedule as a timestep -> [(handler, machine_id)] table, so each
+        # timestep dispatches with one lookup
+        self._event_dispatch = {
+            'machine_failure': self.simulate_machine_failure,
+            'temperature_spike': self.simulate_temperature_spike,
+            'high_load': self.simulate_high_load,
         }
+        self._events_by_ts = defaultdict(list)
+        for event_type, event_data in self.random_events.items():
+            self._events_by_ts[event_data['timestep']].append(
+                (self._event_dispatch[event_type], event_data['machine']))
         
         print(f"Workspace Simulation initialized with {len(self.machines)} machines and {len(self.jobs)} jobs")
         print(f"Random events scheduled: {self.random_events}")
@@ -47,132 +112,118 @@ class WorkspaceSimulation:
         """MQTT connection callback"""
         if rc == 0:
             print("[MQTT] Connected successfully to broker.")
+            # One batch per timestep is a small write; send it without waiting
+            # on Nagle's algorithm to coalesce
+            sock = client.socket()
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+                except (OSError, AttributeError):
+                    pass  # e.g. a websocket transport; keep the defaults
+            # Batches held while offline are flushed by the simulation thread
+            # (publish_timestep / cleanup), so they stay in timestep order
+            self._connected = True
         else:
             print(f"[MQTT] Connection failed with code {rc}.")
     
+    def on_disconnect(self, client, userdata, rc):
+        """MQTT disconnection callback"""
+        self._connected = False
+        if rc != 0:
+            print(f"[MQTT] Unexpected disconnect (code {rc}); buffering timesteps locally.")
+    
     def create_machines(self):
         """Create 5 machines of different classes"""
-        machine_configs = [
-            {"class_name": "A", "machine_id": "A_1", "temp_base": 40, "temp_threshold": 95, 
-             "vib_base": 2, "vib_threshold": 12, "repair_time": 3},
-            {"class_name": "A", "machine_id": "A_2", "temp_base": 42, "temp_threshold": 97, 
-             "vib_base": 2.5, "vib_threshold": 13, "repair_time": 3},
-            {"class_name": "B", "machine_id": "B_1", "temp_base": 50, "temp_threshold": 100, 
-             "vib_base": 4, "vib_threshold": 16, "repair_time": 5},
-            {"class_name": "C", "machine_id": "C_1", "temp_base": 30, "temp_threshold": 90, 
-             "vib_base": 3, "vib_threshold": 14, "repair_time": 4},
-            {"class_name": "D", "machine_id": "D_1", "temp_base": 35, "temp_threshold": 85, 
-             "vib_base": 1.5, "vib_threshold": 10, "repair_time": 2}
-        ]
-        
-        machines = []
-        for config in machine_configs:
-            machine = Machine(
-                class_name=config["class_name"],
-                machine_id=config["machine_id"],
-                temp_base=config["temp_base"],
-                temp_threshold=config["temp_threshold"],
-                vib_base=config["vib_base"],
-                vib_threshold=config["vib_threshold"],
-                repair_time=config["repair_time"]
-            )
-            machines.append(machine)
-        
+        machines = [Machine(*config) for config in MACHINE_CONFIGS]
+        # Interned ids/classes: every alert, template and lookup key shares one
+        # string object (literal ids already are; ids built at runtime are not)
+        for machine in machines:
+            machine.machine_id = sys.intern(machine.machine_id)
+            machine.class_name = sys.intern(machine.class_name)
         return machines
     
-    def create_jobs(self):
-        """Create 10 jobs with different machine requirements"""
-        job_requirements = [
-            ["A_1", "B_1"],           # Job 1: Requires A_1 and B_1
-            ["A_2", "C_1"],           
-            ["B_1", "D_1"],           
-            ["A_1", "A_2", "C_1"],    
-            ["B_1", "C_1", "D_1"],    
-            ["A_1"],                  
-            ["A_2", "B_1"],           
-            ["C_1", "D_1"],           
-            ["A_1", "B_1", "C_1"],    
-            ["A_2", "D_1"]            
-        ]
-        
-        jobs = []
-        for i, requirements in enumerate(job_requirements):
-            job = Job(job_id=f"JOB_{i+1}", machine_requirement=requirements)
-            jobs.append(job)
-        
-        return jobs
-    
-    def get_machine_by_id(self, machine_id):
-        """Get machine object by ID"""
+    def _build_alert_templates(self):
+        """Per-machine alert dicts holding the fixed fields; None marks the per-timestep ones"""
+        self._temp_alert_template = {}
+        self._vib_alert_template = {}
+        self._failure_alert_template = {}
         for machine in self.machines:
-            if machine.machine_id == machine_id:
-                return machine
-        return None
-    
-    def check_sensor_readings(self, machine):
-        """Check if sensor readings are abnormal and send alerts"""
-        alerts = []
-        
-        # Check temperature threshold
-        if machine.temperature >= machine.temp_threshold:
-            alert = {
+            self._temp_alert_template[machine.machine_id] = {
                 "type": "TEMPERATURE_THRESHOLD_EXCEEDED",
                 "machine_id": machine.machine_id,
                 "class_name": machine.class_name,
-                "current_temperature": round(machine.temperature, 2),
+                "current_temperature": None,
                 "threshold": machine.temp_threshold,
-                "timestamp": self.timestep,
+                "timestamp": None,
                 "severity": "HIGH"
             }
-            alerts.append(alert)
-        
-        # Check vibration threshold
-        if machine.vibration >= machine.vib_threshold:
-            alert = {
+            self._vib_alert_template[machine.machine_id] = {
                 "type": "VIBRATION_THRESHOLD_EXCEEDED",
                 "machine_id": machine.machine_id,
                 "class_name": machine.class_name,
-                "current_vibration": round(machine.vibration, 2),
+                "current_vibration": None,
                 "threshold": machine.vib_threshold,
-                "timestamp": self.timestep,
+                "timestamp": None,
                 "severity": "HIGH"
             }
-            alerts.append(alert)
-        
-        # Check if machine is not operational (failed)
-        if not machine.operational:
-            alert = {
+            self._failure_alert_template[machine.machine_id] = {
                 "type": "MACHINE_FAILURE",
                 "machine_id": machine.machine_id,
                 "class_name": machine.class_name,
-                "temperature": round(machine.temperature, 2),
-                "vibration": round(machine.vibration, 2),
-                "repair_progress": f"{machine.repair_timer}/{machine.repair_time}",
-                "timestamp": self.timestep,
+                "temperature": None,
+                "vibration": None,
+                "repair_progress": None,
+                "timestamp": None,
                 "severity": "CRITICAL"
             }
-            alerts.append(alert)
-        
-        # Send alerts to MQTT
-        for alert in alerts:
-            self.send_alert(alert)
-        
-        return alerts
+    
+    def create_jobs(self):
+        """Create 10 jobs, each routed through a sequence of machine classes"""
+        return Job.make_batch(N_JOBS)
+    
+    def get_machine_by_id(self, machine_id):
+        """Get machine object by ID"""
+        return self._machines_by_id.get(machine_id)
     
     def send_alert(self, alert):
-        """Send alert to MQTT broker"""
-        topic = f"{self.MQTT_ALERT_TOPIC}/{alert['machine_id']}"
-        message = json.dumps(alert)
-        self.mqtt_client.publish(topic, message)
-        print(f" ALERT: {alert['type']} - Machine {alert['machine_id']}")
-        print(f" Published to topic '{topic}': {message}")
+        """Add alert to this timestep's MQTT batch"""
+        self._tick_alerts.append(alert)
+        if self.verbose:
+            print(f" ALERT: {alert['type']} - Machine {alert['machine_id']}")
     
     def send_normal_reading(self, machine):
-        """Send normal sensor reading to MQTT"""
-        topic = f"{self.MQTT_TOPIC_PREFIX}/{machine.machine_id}"
-        status_message = machine.get_status(self.timestep)
-        self.mqtt_client.publish(topic, status_message)
-        print(f"Normal reading - Machine {machine.machine_id}: Temp={machine.temperature:.1f}°C, Vib={machine.vibration:.1f}")
+        """Add normal sensor reading to this timestep's MQTT batch"""
+        # status_json re-serializes only when the rounded reading changes; an
+        # unchanged one reuses its cached JSON with just the timestamp spliced in
+        status_message = machine.status_json(self.timestep)
+        self._tick_readings.append(status_message)
+        if self.verbose:
+            print(f"Normal reading - Machine {machine.machine_id}: Temp={machine.temperature:.1f}°C, Vib={machine.vibration:.1f}")
+    
+    def publish_timestep(self):
+        """
+        Publish this timestep's readings and alerts to MQTT as one message.
+        Fire-and-forget: QoS 0, not retained, and the returned MQTTMessageInfo is
+        never waited on, so a slow broker cannot stall the timestep loop.
+        """
+        # Readings are already JSON text, so they are spliced in rather than re-encoded;
+        # paho sends the bytes as they are
+        message = (f'{{"timestep":{self.timestep},"readings":[{",".join(self._tick_readings)}],'
+                   f'"alerts":'.encode() + _dumps(self._tick_alerts) + b"}")
+        self._offline.append(message)
+        if self._connected:
+            self._flush_offline()
+        if self.verbose:
+            print(f" Published {len(self._tick_readings)} readings and {len(self._tick_alerts)} alerts "
+                  f"to topic '{self.MQTT_BATCH_TOPIC}'")
+        self._tick_readings = []
+        self._tick_alerts = []
+    
+    def _flush_offline(self):
+        """Publish held batches, oldest first (simulation thread only)"""
+        while self._offline:
+            self.mqtt_client.publish(self.MQTT_BATCH_TOPIC, self._offline.popleft(), qos=0, retain=False)
     
     def simulate_machine_failure(self, machine_id):
         """Simulate a complete machine failure"""
@@ -181,15 +232,35 @@ class WorkspaceSimulation:
             # Force machine to fail by setting extreme values to replicate real life scenarios where machine fails
             machine.temperature = machine.temp_threshold + 10
             machine.vibration = machine.vib_threshold + 5
-            machine.operational = False
+            # Down for repair_time timesteps; any job it was running is dropped
+            if machine.preempt() is not None:
+                self.current_jobs.pop(machine_id, None)
             print(f" Simulating complete failure of machine {machine_id}")
     
+    def simulate_temperature_spike(self, machine_id):
+        """Simulate a sudden temperature spike"""
+        machine = self.get_machine_by_id(machine_id)
+        if machine and machine.operational:
+            spike_amount = self._rng.uniform(8, 15)
+            machine.temperature += spike_amount
+            print(f" Temperature spike on machine {machine_id}: +{spike_amount:.1f}°C")
+    
+    def simulate_high_load(self, machine_id):
+        """Simulate a burst of high load"""
+        machine = self.get_machine_by_id(machine_id)
+        if machine and machine.operational:
+            load_temp = self._rng.uniform(5, 10)
+            load_vib = self._rng.uniform(2, 4)
+            machine.temperature += load_temp
+            machine.vibration += load_vib
+            print(f" High load on machine {machine_id}: Temp +{load_temp:.1f}°C, Vib +{load_vib:.1f}")
+    
     def assign_job_to_machine(self, job, machine_id):
         """Assign a job to a specific machine"""
         machine = self.get_machine_by_id(machine_id)
-        if machine and machine.operational and machine_id not in self.current_jobs:
+        # Machine.assign checks operational / idle / job's current class
+        if machine and machine_id not in self.current_jobs and machine.assign(job):
             self.current_jobs[machine_id] = job
-            job.start()
             print(f" Job {job.job_id} assigned to machine {machine_id}")
             return True
         return False
@@ -197,10 +268,9 @@ class WorkspaceSimulation:
     def complete_job_on_machine(self, machine_id):
         """Complete the job currently running on a machine"""
         if machine_id in self.current_jobs:
-            job = self.current_jobs[machine_id]
-            job.complete()
+            job = self.current_jobs.pop(machine_id)
+            self.get_machine_by_id(machine_id).busy_with = None
             self.completed_jobs.append(job)
-            del self.current_jobs[machine_id]
             print(f" Job {job.job_id} completed on machine {machine_id}")
     
     def process_timestep(self):
@@ -210,61 +280,97 @@ class WorkspaceSimulation:
         print(f"TIMESTEP {self.timestep}")
         print(f"{'='*60}")
         
-        # Simulate random job processing on machines
-        for machine in self.machines:
-            # Random chance of machine processing a job 
-            if random.random() < 0.4 and machine.operational:  #randomness to replicate real life scenarios
-                # Simulate job processing effects with smaller increments
-                temp_increment = random.uniform(1, 4)  # Reduced from 3-8
-                vib_increment = random.uniform(0.5, 2)  # Reduced from 1-3
-                
-                machine.process_job(temp_increment, vib_increment)
-                print(f"🔧 Machine {machine.machine_id} processing job (Temp: +{temp_increment:.1f}°C, Vib: +{vib_increment:.1f})")
-            else:
-                # Machine is idle - gradual cooling
-                machine.temperature = max(machine.temp_base, machine.temperature - 1.5)
-                machine.vibration = max(machine.vib_base, machine.vibration - 0.3)
-            
-            # Check sensor readings and send alerts if abnormal
-            alerts = self.check_sensor_readings(machine)
+        # Simulate random job processing on all machines at once, on arrays in
+        # self.machines order (the Machine objects get the new readings back below)
+        machines = self.machines
+        n = len(machines)
+        temp = np.fromiter((m.temperature for m in machines), dtype=np.float64, count=n)
+        vib = np.fromiter((m.vibration for m in machines), dtype=np.float64, count=n)
+        operational = np.fromiter((m.operational for m in machines), dtype=bool, count=n)
+        
+        # One draw for the whole timestep: [processing roll, temp increment, vib increment]
+        roll, temp_u, vib_u = self._rng_np.random((3, n))
+        # Random chance of machine processing a job (randomness to replicate real life scenarios)
+        processing = (roll < 0.4) & operational
+        # Simulate job processing effects with smaller increments
+        temp_inc = 1 + 3 * temp_u      # uniform(1, 4), reduced from 3-8
+        vib_inc = 0.5 + 1.5 * vib_u    # uniform(0.5, 2), reduced from 1-3
+        # Processing machines heat up; idle ones cool gradually
+        temp = np.where(processing, temp + temp_inc, np.maximum(self._temp_base, temp - 1.5))
+        vib = np.where(processing, vib + vib_inc, np.maximum(self._vib_base, vib - 0.3))
+        # Sensor checks on the same arrays: threshold exceeded, or machine failed
+        temp_high = temp >= self._temp_thr
+        vib_high = vib >= self._vib_thr
+        failed = ~operational
+        
+        verbose = self.verbose
+        timestep = self.timestep
+        for machine, t, v, busy, t_inc, v_inc, hot, shaking, down in zip(
+                machines, temp.tolist(), vib.tolist(), processing.tolist(),
+                temp_inc.tolist(), vib_inc.tolist(),
+                temp_high.tolist(), vib_high.tolist(), failed.tolist()):
+            machine.temperature = t
+            machine.vibration = v
+            if verbose and busy:
+                print(f"🔧 Machine {machine.machine_id} processing job (Temp: +{t_inc:.1f}°C, Vib: +{v_inc:.1f})")
             
             # Send normal readings if no alerts
-            if not alerts:
+            if not (hot or shaking or down):
                 self.send_normal_reading(machine)
+                continue
+            
+            # Alerts are copies of the machine's templates (key order kept) with the
+            # per-timestep fields filled in; readings go out at full precision
+            # (display rounding is left to the consumer)
+            machine_id = machine.machine_id
+            if hot:
+                alert = self._temp_alert_template[machine_id].copy()
+                alert["current_temperature"] = t
+                alert["timestamp"] = timestep
+                self.send_alert(alert)
+            if shaking:
+                alert = self._vib_alert_template[machine_id].copy()
+                alert["current_vibration"] = v
+                alert["timestamp"] = timestep
+                self.send_alert(alert)
+            if down:
+                alert = self._failure_alert_template[machine_id].copy()
+                alert["temperature"] = t
+                alert["vibration"] = v
+                repaired = machine.repair_time - machine.repairing_left
+                alert["repair_progress"] = f"{repaired}/{machine.repair_time}"
+                alert["timestamp"] = timestep
+                self.send_alert(alert)
+                # One timestep of repair; Machine.step restores base readings when done
+                machine.step()
+        
+        self.publish_timestep()
         
         # Check for random events
-        for event_type, event_data in self.random_events.items():
-            if self.timestep == event_data['timestep']:
-                if event_type == 'machine_failure':
-                    self.simulate_machine_failure(event_data['machine'])
-                elif event_type == 'temperature_spike':
-                    machine = self.get_machine_by_id(event_data['machine'])
-                    if machine and machine.operational:
-                        spike_amount = random.uniform(8, 15)
-                        machine.temperature += spike_amount
-                        print(f" Temperature spike on machine {event_data['machine']}: +{spike_amount:.1f}°C")
-                elif event_type == 'high_load':
-                    machine = self.get_machine_by_id(event_data['machine'])
-                    if machine and machine.operational:
-                        load_temp = random.uniform(5, 10)
-                        load_vib = random.uniform(2, 4)
-                        machine.temperature += load_temp
-                        machine.vibration += load_vib
-                        print(f" High load on machine {event_data['machine']}: Temp +{load_temp:.1f}°C, Vib +{load_vib:.1f}")
+        for handler, machine_id in self._events_by_ts.get(self.timestep, ()):
+            handler(machine_id)
         
         return True
     
-    def run_simulation(self, max_timesteps=20):
-        """Run the complete simulation"""
+    def run_simulation(self, max_timesteps=20, real_time=True, step_seconds=2.0):
+        """
+        Run the complete simulation.
+        real_time paces timesteps step_seconds apart on the wall clock (against a
+        fixed schedule, so processing time does not add drift); with
+        real_time=False the timesteps run back to back.
+        """
         print(" Starting Workspace Simulation...")
         print(f"Machines: {[m.machine_id for m in self.machines]}")
         print(f"Jobs to process: {len(self.jobs)}")
         
         try:
+            next_deadline = time.monotonic()
             while self.timestep < max_timesteps:
                 if not self.process_timestep():
                     break
-                time.sleep(2)  # Wait 2 seconds between timesteps
+                if real_time:
+                    next_deadline += step_seconds
+                    time.sleep(max(0.0, next_deadline - time.monotonic()))
         
         except KeyboardInterrupt:
             print("\n Simulation interrupted by user")
@@ -274,8 +380,13 @@ class WorkspaceSimulation:
     
     def cleanup(self):
         """Clean up MQTT connection"""
-        self.mqtt_client.loop_stop()
+        if self._connected:
+            self._flush_offline()
+        elif self._offline:
+            print(f"[MQTT] Broker unreachable; dropping {len(self._offline)} unsent timesteps.")
+        # Disconnect before stopping the loop so the network thread writes what is queued
         self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
         print("[MQTT] Disconnected gracefully.")
         
         # Print final statistics of the physical workshop setup
@@ -291,7 +402,12 @@ class WorkspaceSimulation:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Workspace sensor simulation publishing to MQTT")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print every machine's reading, alert and processing step each timestep")
+    args = parser.parse_args()
+
     # Create and run the simulation
-    simulation = WorkspaceSimulation()
+    simulation = WorkspaceSimulation(verbose=args.verbose)
     simulation.run_simulation(max_timesteps=15)
 